@@ -0,0 +1,125 @@
+"""
+Per-user change versions and change log, stored in redis.
+
+The version of a user is a counter incremented each time their feeds,
+categories or entries change. API clients get it as an ETag and polls that
+send it back are answered without querying the database. Counters restart
+from 0 if redis loses them, ETags also carry a random epoch created along
+with the counter so that they can't match data from before the loss.
+
+Changes that sync clients need to know about are also appended to a log,
+scored by the version they produced. The log is trimmed to its last
+``CHANGE_LOG_SIZE`` records and expires ``CHANGE_LOG_TTL`` seconds after its
+last write; a cursor older than what the log covers can't be caught up with
+and clients have to sync from scratch.
+"""
+import json
+import uuid
+
+from ..tasks import redis_connection
+
+VERSION_KEY = 'user_version:{0}'
+EPOCH_KEY = 'user_epoch:{0}'
+CHANGE_LOG_KEY = 'user_changes:{0}'
+# Versions strictly lower than this one aren't fully covered by the log
+CHANGE_FLOOR_KEY = 'user_changes_floor:{0}'
+
+CHANGE_LOG_SIZE = 1000
+CHANGE_LOG_TTL = 60 * 60 * 24 * 30
+# Item changes with more ids than this are logged as a reset instead
+CHANGE_MAX_IDS = 500
+
+LOG_SCRIPT = """
+local version = redis.call('incr', KEYS[1])
+if #ARGV == 2 then
+    return version
+end
+if redis.call('exists', KEYS[3]) == 0 then
+    -- New or expired log: it covers the changes from this version on
+    redis.call('set', KEYS[3], version - 1)
+end
+for i = 3, #ARGV do
+    redis.call('zadd', KEYS[2], version, version .. ':' .. ARGV[i])
+end
+local size = tonumber(ARGV[1])
+if redis.call('zremrangebyrank', KEYS[2], 0, -size - 1) > 0 then
+    local first = redis.call('zrange', KEYS[2], 0, 0, 'WITHSCORES')
+    redis.call('set', KEYS[3], first[2])
+end
+redis.call('expire', KEYS[2], ARGV[2])
+redis.call('expire', KEYS[3], ARGV[2])
+return version
+"""
+
+
+def user_version(user_id):
+    return int(redis_connection().get(VERSION_KEY.format(user_id)) or 0)
+
+
+def user_epoch_version(user_id):
+    """
+    Returns the epoch and the version of a user, creating the epoch if it's
+    missing.
+    """
+    pipe = redis_connection().pipeline(transaction=False)
+    pipe.setnx(EPOCH_KEY.format(user_id), uuid.uuid4().hex[:12])
+    pipe.get(EPOCH_KEY.format(user_id))
+    pipe.get(VERSION_KEY.format(user_id))
+    created, epoch, version = pipe.execute()
+    return epoch, int(version or 0)
+
+
+def item_change(kind, ids):
+    """
+    Change record for items: ``kind`` is 'new', 'read', 'unread', 'starred',
+    'unstarred', 'broadcast' or 'unbroadcast'.
+    """
+    ids = list(ids)
+    if len(ids) > CHANGE_MAX_IDS:
+        return {'t': 'reset'}
+    return {'t': kind, 'i': ids}
+
+
+def record_changes(changes):
+    """
+    Bumps the version of several users and logs their changes. ``changes``
+    is a dict of user id -> list of change records, possibly empty.
+    """
+    pipe = redis_connection().pipeline(transaction=False)
+    for user_id, records in changes.items():
+        pipe.eval(LOG_SCRIPT, 3, VERSION_KEY.format(user_id),
+                  CHANGE_LOG_KEY.format(user_id),
+                  CHANGE_FLOOR_KEY.format(user_id), CHANGE_LOG_SIZE,
+                  CHANGE_LOG_TTL,
+                  *[json.dumps(record, separators=(',', ':'))
+                    for record in records])
+    pipe.execute()
+
+
+def bump_versions(user_ids):
+    record_changes(dict((user_id, []) for user_id in user_ids))
+
+
+def bump_version(user_id, *records):
+    record_changes({user_id: records})
+
+
+def changes_since(user_id, version):
+    """
+    Returns the current version of a user and the list of changes logged
+    after ``version``, or None if the log doesn't go back that far.
+    """
+    pipe = redis_connection().pipeline(transaction=False)
+    pipe.get(VERSION_KEY.format(user_id))
+    pipe.get(CHANGE_FLOOR_KEY.format(user_id))
+    pipe.zrangebyscore(CHANGE_LOG_KEY.format(user_id), version + 1, '+inf')
+    current, floor, records = pipe.execute()
+    current = int(current or 0)
+    # Without a floor the log has expired, or was never written to
+    floor = current if floor is None else int(floor)
+    if version > current or version < floor:
+        return current, None
+    changes = [json.loads(record.split(':', 1)[1]) for record in records]
+    if any([change['t'] == 'reset' for change in changes]):
+        return current, None
+    return current, changes
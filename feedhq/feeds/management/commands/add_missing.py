@@ -2,7 +2,7 @@ from collections import Counter
 
 from django.conf import settings
 
-from ...models import Feed, UniqueFeed, enqueue_favicon
+from ...models import Feed, UniqueFeed, enqueue_favicons
 from . import SentryCommand
 
 
@@ -33,5 +33,4 @@ class Command(SentryCommand):
                         where f.url = u.link
                     )
                 """)
-            for feed in missing_favicons:
-                enqueue_favicon(feed.link)
+            enqueue_favicons([feed.link for feed in missing_favicons])
@@ -0,0 +1,41 @@
+import logging
+import time
+
+from optparse import make_option
+
+from django.db import connection, transaction
+
+from ...models import URL_HASH
+from . import SentryCommand
+
+logger = logging.getLogger('feedupdater')
+
+BACKFILL = """
+    UPDATE feeds_entry SET link_hash = {link}, guid_hash = {guid}
+    WHERE id > %s AND id <= %s AND (link_hash IS NULL OR guid_hash IS NULL)
+""".format(link=URL_HASH.format('link'), guid=URL_HASH.format('guid'))
+
+
+class Command(SentryCommand):
+    """Sets the link and guid hashes of entries created before they existed.
+
+    Entries are processed in id ranges, one transaction each."""
+    option_list = SentryCommand.option_list + (
+        make_option('--chunk', action='store', type='int', dest='chunk',
+                    default=5000, help='Number of entries per transaction'),
+        make_option('--sleep', action='store', type='float', dest='sleep',
+                    default=0, help='Pause between chunks, in seconds'),
+    )
+
+    def handle_sentry(self, *args, **options):
+        cursor = connection.cursor()
+        cursor.execute("SELECT max(id) FROM feeds_entry")
+        last = cursor.fetchone()[0] or 0
+        updated = 0
+        for start in range(0, last, options['chunk']):
+            cursor.execute(BACKFILL, [start, start + options['chunk']])
+            updated += cursor.rowcount
+            transaction.commit_unless_managed()
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        logger.info("Hashed the link and guid of {0} entries".format(updated))
@@ -1,4 +1,6 @@
 from ...models import UniqueFeed
+from ...scheduling import unschedule_feeds
+from ...state import delete_states
 from . import SentryCommand
 
 
@@ -8,9 +10,11 @@ class Command(SentryCommand):
     def handle_sentry(self, *args, **kwargs):
         unsubscribed = UniqueFeed.objects.raw(
             """
-            select id from feeds_uniquefeed u where not exists (
+            select id, url from feeds_uniquefeed u where not exists (
                 select 1 from feeds_feed f where f.url = u.url
             )
             """)
-        pks = [u.pk for u in unsubscribed]
-        UniqueFeed.objects.filter(pk__in=pks).delete()
+        unsubscribed = list(unsubscribed)
+        UniqueFeed.objects.filter(pk__in=[u.pk for u in unsubscribed]).delete()
+        unschedule_feeds([u.url for u in unsubscribed])
+        delete_states([u.url for u in unsubscribed])
@@ -1,6 +1,6 @@
 from optparse import make_option
 
-from ...models import UniqueFeed, enqueue_favicon
+from ...models import UniqueFeed, enqueue_favicons
 from . import SentryCommand
 
 
@@ -18,5 +18,4 @@ class Command(SentryCommand):
 
     def handle_sentry(self, *args, **kwargs):
         links = UniqueFeed.objects.values_list('link', flat=True).distinct()
-        for link in links:
-            enqueue_favicon(link, force_update=kwargs['all'])
+        enqueue_favicons(links, force_update=kwargs['all'])
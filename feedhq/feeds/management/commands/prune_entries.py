@@ -0,0 +1,82 @@
+import logging
+import time
+
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from ...changes import bump_versions
+from . import SentryCommand
+
+logger = logging.getLogger('feedupdater')
+
+# Deletes a chunk of read, unstarred entries older than the retention period
+# of their user, in id order starting after a given id. Only read entries are
+# deleted, the conditions are repeated outside of the subquery so that entries
+# marked as unread concurrently are kept and unread counts stay exact.
+PRUNE = """
+    DELETE FROM feeds_entry
+    WHERE read AND NOT starred AND id IN (
+        SELECT e.id FROM feeds_entry e
+        INNER JOIN auth_user u ON u.id = e.user_id
+        WHERE e.id > %(start)s AND e.read AND NOT e.starred
+            AND (u.retention_days > 0 OR %(days)s > 0)
+            AND e.date < now() - interval '1 day' * (
+                CASE WHEN u.retention_days > 0 THEN u.retention_days
+                ELSE %(days)s END
+            )
+        ORDER BY e.id LIMIT %(chunk)s
+    )
+    RETURNING id, shared_content_id, user_id
+"""
+
+# Deletes shared contents that no entry points to anymore.
+PRUNE_CONTENTS = """
+    DELETE FROM feeds_entrycontent c
+    WHERE c.id IN ({contents}) AND NOT EXISTS (
+        SELECT 1 FROM feeds_entry e WHERE e.shared_content_id = c.id
+    )
+"""
+
+
+class Command(SentryCommand):
+    """Deletes old read entries.
+
+    Read entries that aren't starred are kept for the retention period of
+    their user, or ENTRY_RETENTION_DAYS if the user hasn't set one. Entries
+    are deleted in chunks, one transaction each."""
+    option_list = SentryCommand.option_list + (
+        make_option('--days', action='store', type='int', dest='days',
+                    default=None,
+                    help='Default retention period, in days'),
+        make_option('--chunk', action='store', type='int', dest='chunk',
+                    default=1000, help='Number of entries per transaction'),
+        make_option('--sleep', action='store', type='float', dest='sleep',
+                    default=0.1, help='Pause between chunks, in seconds'),
+    )
+
+    def handle_sentry(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = settings.ENTRY_RETENTION_DAYS
+        cursor = connection.cursor()
+        start = deleted = 0
+        while True:
+            cursor.execute(PRUNE, {'start': start, 'days': days,
+                                   'chunk': options['chunk']})
+            rows = cursor.fetchall()
+            contents = set([content for pk, content, user in rows
+                            if content is not None])
+            if contents:
+                cursor.execute(PRUNE_CONTENTS.format(
+                    contents=', '.join(['%s'] * len(contents))),
+                    list(contents))
+            transaction.commit_unless_managed()
+            if not rows:
+                break
+            bump_versions(set([user for pk, content, user in rows]))
+            deleted += len(rows)
+            start = max([pk for pk, content, user in rows])
+            time.sleep(options['sleep'])
+        logger.info("Deleted {0} read entries".format(deleted))
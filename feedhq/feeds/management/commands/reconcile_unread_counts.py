@@ -0,0 +1,51 @@
+import logging
+
+from optparse import make_option
+
+from django.db import connection, transaction
+
+from ...changes import bump_versions
+from . import SentryCommand
+
+logger = logging.getLogger('feedupdater')
+
+# Sets the unread count of feeds in an id range to the actual number of
+# unread entries, only touching the feeds that drifted.
+RECONCILE = """
+    UPDATE feeds_feed SET unread_count = counts.unread
+    FROM (
+        SELECT f.id, count(e.id) AS unread
+        FROM feeds_feed f
+        LEFT OUTER JOIN feeds_entry e ON e.feed_id = f.id AND e.read = false
+        WHERE f.id > %s AND f.id <= %s
+        GROUP BY f.id
+    ) AS counts
+    WHERE feeds_feed.id = counts.id
+        AND feeds_feed.unread_count != counts.unread
+    RETURNING feeds_feed.user_id
+"""
+
+
+class Command(SentryCommand):
+    """Repairs the unread counts of feeds.
+
+    Counts are updated by delta when entries are stored or change state, this
+    fixes any drift. Feeds are processed in id ranges, one transaction each."""
+    option_list = SentryCommand.option_list + (
+        make_option('--chunk', action='store', type='int', dest='chunk',
+                    default=1000, help='Number of feeds per transaction'),
+    )
+
+    def handle_sentry(self, *args, **options):
+        cursor = connection.cursor()
+        cursor.execute("SELECT max(id) FROM feeds_feed")
+        last = cursor.fetchone()[0] or 0
+        fixed = 0
+        for start in range(0, last, options['chunk']):
+            cursor.execute(RECONCILE, [start, start + options['chunk']])
+            users = set([user for user, in cursor.fetchall()])
+            fixed += cursor.rowcount
+            transaction.commit_unless_managed()
+            # Cached unread counts and ETags are based on the user versions
+            bump_versions(users)
+        logger.info("Fixed the unread count of {0} feeds".format(fixed))
@@ -0,0 +1,43 @@
+import logging
+
+from optparse import make_option
+
+from django.db import transaction
+
+from ...models import Entry, EntryContent, SANITIZER_VERSION
+from . import SentryCommand
+
+logger = logging.getLogger('feedupdater')
+
+
+class Command(SentryCommand):
+    """Sanitizes the contents stored before the current sanitizer version.
+
+    Contents are processed in id order, one transaction per chunk."""
+    option_list = SentryCommand.option_list + (
+        make_option('--chunk', action='store', type='int', dest='chunk',
+                    default=500, help='Number of contents per transaction'),
+    )
+
+    def handle_sentry(self, *args, **options):
+        start = updated = 0
+        while True:
+            contents = list(EntryContent.objects.filter(pk__gt=start).exclude(
+                sanitizer_version=SANITIZER_VERSION).order_by('pk')[
+                    :options['chunk']])
+            if not contents:
+                break
+            urls = dict(Entry.objects.filter(
+                shared_content__in=contents).order_by().distinct().values_list(
+                    'shared_content_id', 'feed__url'))
+            for content in contents:
+                if content.pk not in urls:
+                    continue  # Orphan, will be pruned
+                content.sanitize(urls[content.pk])
+                content.save(update_fields=['base_url', 'sanitized',
+                                            'sanitized_nomedia',
+                                            'sanitizer_version'])
+                updated += 1
+            transaction.commit_unless_managed()
+            start = contents[-1].pk
+        logger.info("Sanitized {0} contents".format(updated))
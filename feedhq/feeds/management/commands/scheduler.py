@@ -0,0 +1,115 @@
+import datetime
+import logging
+import time
+
+from optparse import make_option
+
+from django.utils import timezone
+
+from ...models import UniqueFeed
+from ...scheduling import (backpressure, enqueue_updates, next_due_in,
+                           pop_due_feeds, schedule_feeds, scheduled_feeds,
+                           unschedule_feeds, THROTTLE_MIN)
+from . import SentryCommand
+
+logger = logging.getLogger('feedupdater')
+
+
+class Command(SentryCommand):
+    """Continuously enqueues feed updates as they come due.
+
+    Due dates live in a redis sorted set that the update jobs keep up to date
+    after each fetch. Postgres is only queried for the feeds being enqueued
+    and for a periodic reconciliation of the sorted set."""
+    option_list = SentryCommand.option_list + (
+        make_option('--batch', action='store', type='int', dest='batch',
+                    default=100,
+                    help='Maximum number of feeds enqueued at once'),
+        make_option('--sync', action='store', type='int', dest='sync',
+                    default=3600,
+                    help='Seconds between reconciliations with the database'),
+        make_option('--max-sleep', action='store', type='float',
+                    dest='max_sleep', default=5,
+                    help='Maximum number of seconds between two polls'),
+    )
+
+    def handle_sentry(self, *args, **options):
+        self.last_sync = None
+        while True:
+            try:
+                delay = self.poll(options)
+            except Exception:
+                # Database or redis hiccups mustn't stop the scheduler. The
+                # feedupdater logger reports to sentry.
+                logger.exception("Scheduler poll failed")
+                delay = options['max_sleep']
+            if delay:
+                time.sleep(delay)
+
+    def poll(self, options):
+        """
+        Syncs the schedule when it's due and enqueues due feeds. Returns the
+        number of seconds to sleep before polling again.
+        """
+        if (self.last_sync is None or
+                time.time() - self.last_sync > options['sync']):
+            self.sync()
+            self.last_sync = time.time()
+
+        # Let workers catch up when the queue is full
+        count = backpressure(options['batch'])
+        if count and self.tick(count):
+            return 0
+
+        delay = next_due_in() if count else None
+        if delay is None or delay > options['max_sleep']:
+            delay = options['max_sleep']
+        return delay
+
+    def tick(self, count):
+        """
+        Enqueues up to ``count`` due feeds. Returns the number of feeds popped
+        from the schedule.
+        """
+        urls = pop_due_feeds(count)
+        if not urls:
+            return 0
+
+        uniques = list(UniqueFeed.objects.filter(
+            url__in=urls, muted=False).only('url', 'backoff_factor'))
+        queued = set()
+        try:
+            deferred = enqueue_updates(uniques, queued)
+        except Exception:
+            # Don't lose feeds that weren't enqueued
+            deferred = [u for u in uniques if u.pk not in queued]
+            raise
+        finally:
+            retry = timezone.now() + datetime.timedelta(seconds=THROTTLE_MIN)
+            schedule_feeds(dict((u.url, retry) for u in deferred))
+            if queued:
+                UniqueFeed.objects.filter(pk__in=list(queued)).update(
+                    last_loop=timezone.now())
+        return len(urls)
+
+    def sync(self):
+        """
+        Adds unmuted feeds missing from the schedule and removes stale URLs.
+        Feeds enqueued recently are left alone, their job schedules them
+        again once it has run.
+        """
+        scheduled = scheduled_feeds()
+        recent = timezone.now() - datetime.timedelta(hours=1)
+        feeds = UniqueFeed.objects.filter(muted=False).values_list(
+            'url', 'next_update', 'last_loop')
+        missing = {}
+        known = set()
+        for url, next_update, last_loop in feeds.iterator():
+            known.add(url)
+            if url not in scheduled and last_loop < recent:
+                missing[url] = next_update
+        stale = scheduled - known
+        schedule_feeds(missing)
+        unschedule_feeds(list(stale))
+        logger.debug("Schedule synced: {0} feeds added, {1} removed".format(
+            len(missing), len(stale)))
@@ -2,11 +2,12 @@ import logging
 import os
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from raven import Client
 
-from ....tasks import enqueue
 from ...models import UniqueFeed
+from ...scheduling import backpressure, enqueue_updates
 from ...tasks import update_feed
 from . import SentryCommand
 
@@ -15,20 +16,15 @@ logger = logging.getLogger('feedupdater')
 
 TO_UPDATE = """
     SELECT
-        id, url, modified, etag, backoff_factor, muted_reason, link, title,
-        hub, subscribers, backoff_factor * {timeout_base} as tm
+        id, url, backoff_factor, backoff_factor * {timeout_base} as tm
     FROM feeds_uniquefeed
-    WHERE
-        muted='false' AND
-        (last_update + {update_period} * interval '1 minute' *
-            backoff_factor^{backoff_exponent} < current_timestamp)
+    WHERE muted = false AND next_update < current_timestamp
     ORDER BY last_loop ASC
     LIMIT %s
-""".format(
-    timeout_base=UniqueFeed.TIMEOUT_BASE,
-    update_period=UniqueFeed.UPDATE_PERIOD,
-    backoff_exponent=UniqueFeed.BACKOFF_EXPONENT,
-)
+""".format(timeout_base=UniqueFeed.TIMEOUT_BASE)
+
+UNMUTED_COUNT_KEY = 'updatefeeds:unmuted_count'
+UNMUTED_COUNT_TIMEOUT = 3600
 
 
 class Command(SentryCommand):
@@ -40,35 +36,28 @@ class Command(SentryCommand):
             feed = UniqueFeed.objects.get(pk=pk)
             feed.last_loop = timezone.now()
             feed.save(update_fields=['last_loop'])
-            return update_feed(
-                feed.url, etag=feed.etag, last_modified=feed.modified,
-                subscribers=feed.subscribers,
-                request_timeout=feed.request_timeout,
-                backoff_factor=feed.backoff_factor, error=feed.error,
-                link=feed.link, title=feed.title, hub=feed.hub,
-            )
+            return update_feed(feed.url, **feed.update_kwargs())
 
         ratio = UniqueFeed.UPDATE_PERIOD // 5
 
-        uniques = UniqueFeed.objects.raw(
-            TO_UPDATE,
-            [max(1, UniqueFeed.objects.filter(muted=False).count() // ratio)])
-        queued = set()
+        # The number of feeds only sets the batch size, it doesn't need to
+        # be exact.
+        count = cache.get(UNMUTED_COUNT_KEY)
+        if count is None:
+            count = UniqueFeed.objects.filter(muted=False).count()
+            cache.set(UNMUTED_COUNT_KEY, count, UNMUTED_COUNT_TIMEOUT)
 
+        # Don't add to the backlog if workers can't keep up
+        limit = backpressure(max(1, count // ratio))
+        if not limit:
+            return
+        uniques = UniqueFeed.objects.raw(TO_UPDATE, [limit])
+
+        # Spread the load across hosts. Feeds from throttled hosts or above
+        # the per-host limit keep their last_loop and go first next time.
+        queued = set()
         try:
-            for unique in uniques:
-                enqueue(update_feed, args=[unique.url], kwargs={
-                    'etag': unique.etag,
-                    'last_modified': unique.modified,
-                    'subscribers': unique.subscribers,
-                    'request_timeout': unique.backoff_factor * 10,
-                    'backoff_factor': unique.backoff_factor,
-                    'error': unique.error,
-                    'link': unique.link,
-                    'title': unique.title,
-                    'hub': unique.hub,
-                }, timeout=unique.tm)
-                queued.add(unique.pk)
+            enqueue_updates(list(uniques), queued)
         except Exception:  # We don't know what to expect, and anyway
                            # we're reporting the exception
             if settings.DEBUG or not 'SENTRY_DSN' in os.environ:
@@ -15,7 +15,10 @@ import requests
 import socket
 import struct
 
-from django.db import models
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+from django.db import IntegrityError, connection, models, transaction
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
@@ -28,16 +31,22 @@ from django.utils.translation import ugettext_lazy as _
 from django_push.subscriber.signals import updated
 from httplib import IncompleteRead
 from lxml.etree import ParserError
-from redis.exceptions import ResponseError
 from requests.packages.urllib3.exceptions import LocationParseError
+from rq.timeouts import JobTimeoutException
 
 import pytz
 
+from .changes import bump_version, item_change, record_changes
 from .fields import URLField
-from .tasks import update_feed, update_favicon, store_entries
+from .scheduling import (HostLimiter, feed_host, parse_retry_after,
+                         schedule_feed, throttle_host, unschedule_feeds)
+from .sessions import session_pool
+from .state import (STATE_FIELDS, delete_states, get_states, save_state,
+                    save_states)
+from .tasks import update_feed, update_favicon, queue_entries
 from .utils import FAVICON_FETCHER, USER_AGENT
 from ..storage import OverwritingStorage
-from ..tasks import enqueue
+from ..tasks import enqueue, enqueue_many
 
 logger = logging.getLogger('feedupdater')
 
@@ -83,11 +92,24 @@ TIMEDELTAS = {
 }
 
 
+# Outcome of a feed request: either a response and the time it took, or the
+# network error that was raised.
+Fetched = namedtuple('Fetched', ['response', 'elapsed', 'exception'])
+
+
 def enqueue_favicon(url, force_update=False):
     enqueue(update_favicon, args=[url], kwargs={'force_update': force_update},
             queue='favicons')
 
 
+def enqueue_favicons(urls, force_update=False):
+    enqueue_many([{
+        'function': update_favicon,
+        'args': [url],
+        'kwargs': {'force_update': force_update},
+    } for url in urls], queue='favicons')
+
+
 class CategoryManager(models.Manager):
     def with_unread_counts(self):
         return self.values('id', 'name', 'slug', 'color').annotate(
@@ -148,9 +170,109 @@ class Category(models.Model):
 
 
 class UniqueFeedManager(models.Manager):
+    def load_update_kwargs(self, urls):
+        """
+        ``update_feed`` keyword arguments of several feeds, read from their
+        fetch state in redis or from the database when there is none. Returns
+        a dict of URL -> kwargs, deleted feeds are left out.
+        """
+        states = dict(zip(urls, get_states(urls)))
+        missing = [url for url, state in states.items() if state is None]
+        if missing:
+            fresh = dict((unique.url, unique.fetch_state()) for unique in
+                         self.filter(url__in=missing).only('url',
+                                                           *STATE_FIELDS))
+            save_states(fresh)
+            states.update(fresh)
+        return dict((url, UniqueFeed.state_kwargs(state))
+                    for url, state in states.items() if state is not None)
+
     def update_feed(self, url, etag=None, last_modified=None, subscribers=1,
                     request_timeout=10, backoff_factor=1, previous_error=None,
-                    link=None, title=None, hub=None):
+                    link=None, title=None, hub=None, content_hash=None,
+                    update_interval=None):
+        fetched = self.fetch(url, etag=etag, last_modified=last_modified,
+                             subscribers=subscribers,
+                             request_timeout=request_timeout)
+        self.handle_fetch(url, fetched, subscribers=subscribers,
+                          backoff_factor=backoff_factor,
+                          previous_error=previous_error, link=link,
+                          title=title, hub=hub, content_hash=content_hash,
+                          update_interval=update_interval)
+
+    def update_feeds(self, feeds, concurrency=None, callback=None):
+        """
+        Updates a batch of feeds. Network fetches run concurrently in a
+        thread pool, responses are processed one by one in the calling
+        thread as soon as they arrive.
+
+        ``feeds`` is a list of dicts taking the same keys as the
+        ``update_feed`` task. ``callback`` is called with each URL once its
+        response has been processed.
+
+        A feed whose update raises is logged and backed off, the rest of the
+        batch goes on.
+        """
+        if not feeds:
+            return
+        if concurrency is None:
+            concurrency = settings.FETCH_CONCURRENCY
+
+        limit = HostLimiter(settings.FETCH_HOST_CONCURRENCY)
+
+        def fetch(feed):
+            try:
+                with limit(feed['url']):
+                    return feed, self.fetch(
+                        feed['url'], etag=feed.get('etag'),
+                        last_modified=feed.get('last_modified'),
+                        subscribers=feed.get('subscribers', 1),
+                        request_timeout=feed.get('request_timeout', 10))
+            except JobTimeoutException:
+                raise
+            except Exception:
+                logger.exception("Failed to fetch {0}".format(feed['url']))
+                return feed, None
+
+        pool = ThreadPool(max(1, min(concurrency, len(feeds))))
+        try:
+            for feed, fetched in pool.imap_unordered(fetch, feeds):
+                try:
+                    if fetched is not None:
+                        self.handle_fetch(
+                            feed['url'], fetched,
+                            subscribers=feed.get('subscribers', 1),
+                            backoff_factor=feed.get('backoff_factor', 1),
+                            previous_error=feed.get('error'),
+                            link=feed.get('link'), title=feed.get('title'),
+                            hub=feed.get('hub'),
+                            content_hash=feed.get('content_hash'),
+                            update_interval=feed.get('update_interval'))
+                except JobTimeoutException:
+                    raise
+                except Exception:
+                    transaction.rollback_unless_managed()
+                    logger.exception("Failed to update {0}".format(
+                        feed['url']))
+                    fetched = None
+                if fetched is None:
+                    self.backoff_feed(feed['url'], feed.get('error'),
+                                      feed.get('backoff_factor', 1),
+                                      feed.get('update_interval'))
+                if callback is not None:
+                    callback(feed['url'])
+        finally:
+            pool.terminate()
+        logger.debug("Session pool: {size} hosts, {hits} hits, {misses} "
+                     "misses, {evictions} evictions".format(
+                         **session_pool.stats()))
+
+    def fetch(self, url, etag=None, last_modified=None, subscribers=1,
+              request_timeout=10):
+        """
+        Performs the HTTP request for a feed. Network errors are returned,
+        not raised, so that this can safely run outside of the main thread.
+        """
         if subscribers == 1:
             subscribers_text = '1 subscriber'
         else:
@@ -166,18 +288,26 @@ class UniqueFeedManager(models.Manager):
         if etag:
             headers['If-None-Match'] = etag
 
-        if settings.TESTS:
-            # Make sure requests.get is properly mocked during tests
-            if str(type(requests.get)) != "<class 'mock.MagicMock'>":
-                raise ValueError("Not Mocked")
-
         start = datetime.datetime.now()
-        error = None
         try:
-            response = requests.get(url, headers=headers,
-                                    timeout=request_timeout)
+            response = session_pool.get(url, headers=headers,
+                                        timeout=request_timeout)
         except (requests.RequestException, socket.timeout, socket.error,
-                IncompleteRead) as e:
+                IncompleteRead, LocationParseError) as e:
+            return Fetched(None, None, e)
+        elapsed = (datetime.datetime.now() - start).seconds
+        return Fetched(response, elapsed, None)
+
+    def handle_fetch(self, url, fetched, subscribers=1, backoff_factor=1,
+                     previous_error=None, link=None, title=None, hub=None,
+                     content_hash=None, update_interval=None):
+        error = None
+        e = fetched.exception
+        if isinstance(e, LocationParseError):
+            logger.debug("Failed to parse URL for {0}".format(url))
+            self.mute_feed(url, UniqueFeed.PARSE_ERROR)
+            return
+        elif e is not None:
             logger.debug("Error fetching %s, %s" % (url, str(e)))
             if backoff_factor == UniqueFeed.MAX_BACKOFF - 1:
                 logger.debug(
@@ -187,14 +317,10 @@ class UniqueFeedManager(models.Manager):
                 error = UniqueFeed.CONNECTION_ERROR
             else:
                 error = UniqueFeed.TIMEOUT
-            self.backoff_feed(url, error, backoff_factor)
-            return
-        except LocationParseError:
-            logger.debug("Failed to parse URL for {0}".format(url))
-            self.mute_feed(url, UniqueFeed.PARSE_ERROR)
+            self.backoff_feed(url, error, backoff_factor, update_interval)
             return
 
-        elapsed = (datetime.datetime.now() - start).seconds
+        response, elapsed = fetched.response, fetched.elapsed
 
         ctype = response.headers.get('Content-Type', None)
         if (response.history and
@@ -222,12 +348,20 @@ class UniqueFeedManager(models.Manager):
             self.mute_feed(url, UniqueFeed.GONE)
             return
 
+        elif response.status_code == 429 or (
+                response.status_code == 503 and
+                'retry-after' in response.headers):
+            # Rate limited: retry when the host allows it, not backoff.
+            self.throttle_feed(url, response.headers.get('retry-after'))
+            return
+
         elif response.status_code in [400, 401, 403, 404, 500, 502, 503]:
             if backoff_factor == UniqueFeed.MAX_BACKOFF - 1:
                 logger.debug("{0} reached max backoff period ({1})".format(
                     url, response.status_code,
                 ))
-            self.backoff_feed(url, str(response.status_code), backoff_factor)
+            self.backoff_feed(url, str(response.status_code), backoff_factor,
+                              update_interval)
             return
 
         elif response.status_code not in [200, 204, 304]:
@@ -244,7 +378,7 @@ class UniqueFeedManager(models.Manager):
 
         if response.status_code == 304:
             logger.debug("Feed not modified, {0}".format(url))
-            self.filter(url=url).update(**update)
+            self.save_update(url, update, backoff_factor, update_interval)
             return
 
         if 'etag' in response.headers:
@@ -264,8 +398,18 @@ class UniqueFeedManager(models.Manager):
                 content = response.content
         except socket.timeout:
             logger.debug('{0} timed out'.format(url))
-            self.backoff_feed(url, UniqueFeed.TIMEOUT, backoff_factor)
+            self.backoff_feed(url, UniqueFeed.TIMEOUT, backoff_factor,
+                              update_interval)
+            return
+
+        # Plenty of servers ignore conditional requests. Skip parsing and
+        # storing if the body is the same as last time.
+        update['content_hash'] = hashlib.sha1(content).hexdigest()
+        if update['content_hash'] == content_hash:
+            logger.debug("Feed content unchanged, {0}".format(url))
+            self.save_update(url, update, backoff_factor, update_interval)
             return
+
         parsed = feedparser.parse(content)
 
         if 'link' in parsed.feed and parsed.feed.link != link:
@@ -280,19 +424,17 @@ class UniqueFeedManager(models.Manager):
                     update['hub'] = link.href
                     # TODO actually subscribe
 
-        self.filter(url=url).update(**update)
+        interval = self.update_interval(parsed, update_interval)
+        if interval is not None and interval != update_interval:
+            update['update_interval'] = interval
+
+        self.save_update(url, update, backoff_factor, update_interval)
 
         entries = filter(
             None,
             [self.entry_data(entry, parsed) for entry in parsed.entries]
         )
-        try:
-            enqueue(store_entries, args=[url, entries], queue='store')
-        except ResponseError:
-            # Protocol error: too big bulk count string
-            # Redis can't handle this. Enqueue synchronously for now.
-            logger.info("Synchronously storing entries for {0}".format(url))
-            store_entries(url, entries)
+        queue_entries(url, entries)
 
     @classmethod
     def entry_data(cls, entry, parsed):
@@ -342,23 +484,95 @@ class UniqueFeedManager(models.Manager):
                 entry_date = timezone.now()
         return entry_date
 
+    @classmethod
+    def update_interval(cls, parsed, previous=None):
+        """
+        Estimates how often a feed should be polled, in minutes, from the
+        publication dates of its entries: twice per average interval between
+        entries, or per time since the last entry if the feed went quiet.
+        The estimate is smoothed with the previous interval.
+        """
+        dates = []
+        for entry in parsed.entries:
+            field = (entry.get('published_parsed') or
+                     entry.get('updated_parsed'))
+            if field is not None:
+                dates.append(timezone.make_aware(
+                    datetime.datetime(*field[:6]), pytz.utc))
+        if len(dates) < 2:
+            return previous
+        dates.sort()
+        now = timezone.now()
+        average = (dates[-1] - dates[0]) // (len(dates) - 1)
+        gap = max(average, now - dates[-1])
+        minutes = (gap.days * 86400 + gap.seconds) // 60 // 2
+        if previous:
+            minutes = (minutes + previous) // 2
+        return max(UniqueFeed.MIN_UPDATE_INTERVAL,
+                   min(UniqueFeed.MAX_UPDATE_INTERVAL, minutes))
+
     def handle_redirection(self, old_url, new_url, subscribers):
         logger.debug("{0} moved to {1}".format(old_url, new_url))
-        Feed.objects.filter(url=old_url).update(url=new_url)
+        feeds = Feed.objects.filter(url=old_url)
+        users = list(feeds.values_list('user_id', flat=True))
+        feeds.update(url=new_url)
+        record_changes(dict((user, [
+            {'t': 'unsubscribe', 's': u'feed/{0}'.format(old_url)},
+            {'t': 'subscribe', 's': u'feed/{0}'.format(new_url)},
+        ]) for user in users))
         unique, created = self.get_or_create(
             url=new_url, defaults={'subscribers': subscribers})
         if created and not settings.TESTS:
             enqueue_favicon(new_url)
         self.filter(url=old_url).delete()
+        unschedule_feeds([old_url])
+        delete_states([old_url])
+
+    def save_update(self, url, update, backoff_factor, update_interval):
+        """
+        Saves the outcome of a successful fetch and schedules the next one.
+        """
+        update['next_update'] = UniqueFeed.schedule(
+            update['last_update'],
+            update.get('update_interval', update_interval),
+            update.get('backoff_factor', backoff_factor))
+        self.filter(url=url).update(**update)
+        save_state(url, **update)
+        schedule_feed(url, update['next_update'])
 
     def mute_feed(self, url, reason):
+        now = timezone.now()
         self.filter(url=url).update(muted=True, error=reason,
-                                    last_update=timezone.now())
-
-    def backoff_feed(self, url, error, backoff_factor):
-        self.filter(url=url).update(error=error, last_update=timezone.now(),
-                                    backoff_factor=min(UniqueFeed.MAX_BACKOFF,
-                                                       backoff_factor + 1))
+                                    last_update=now, next_update=now)
+        save_state(url, error=reason)
+        unschedule_feeds([url])
+
+    def backoff_feed(self, url, error, backoff_factor, update_interval=None):
+        now = timezone.now()
+        backoff_factor = min(UniqueFeed.MAX_BACKOFF, backoff_factor + 1)
+        next_update = UniqueFeed.schedule(now, update_interval,
+                                          backoff_factor)
+        self.filter(url=url).update(
+            error=error, last_update=now, backoff_factor=backoff_factor,
+            next_update=next_update)
+        save_state(url, error=error, backoff_factor=backoff_factor)
+        schedule_feed(url, next_update)
+
+    def throttle_feed(self, url, retry_after):
+        """
+        Marks the feed's host as throttled and makes the feed due again
+        once the host's Retry-After delay has passed.
+        """
+        seconds = parse_retry_after(retry_after)
+        logger.debug("{0} throttled for {1}s".format(url, seconds))
+        throttle_host(feed_host(url), seconds)
+        now = timezone.now()
+        next_update = now + datetime.timedelta(seconds=seconds)
+        self.filter(url=url).update(
+            error=UniqueFeed.THROTTLED, last_update=now,
+            next_update=next_update)
+        save_state(url, error=UniqueFeed.THROTTLED)
+        schedule_feed(url, next_update)
 
     def safe_backoff(self, response_time):
         """
@@ -375,6 +589,7 @@ class UniqueFeed(models.Model):
     TIMEOUT = 'timeout'
     PARSE_ERROR = 'parseerror'
     CONNECTION_ERROR = 'connerror'
+    THROTTLED = 'throttled'
     HTTP_400 = '400'
     HTTP_401 = '401'
     HTTP_403 = '403'
@@ -387,6 +602,7 @@ class UniqueFeed(models.Model):
         (TIMEOUT, 'Feed timed out'),
         (PARSE_ERROR, 'Location parse error'),
         (CONNECTION_ERROR, 'Connection error'),
+        (THROTTLED, 'Rate limited (429)'),
         (HTTP_400, 'HTTP 400'),
         (HTTP_401, 'HTTP 401'),
         (HTTP_403, 'HTTP 403'),
@@ -416,11 +632,22 @@ class UniqueFeed(models.Model):
                                      db_index=True)
     subscribers = models.PositiveIntegerField(_('Subscribers'), default=1,
                                               db_index=True)
+    # Derived from last_update, update_interval and backoff_factor. Indexed
+    # for unmuted feeds only, see migration 0016.
+    next_update = models.DateTimeField(_('Next update'), default=timezone.now)
+    # Polling interval in minutes, learnt from the feed's publishing rate
+    update_interval = models.PositiveIntegerField(_('Update interval'),
+                                                  default=60)
+    # SHA1 of the last response body
+    content_hash = models.CharField(_('Content hash'), max_length=40,
+                                    blank=True)
 
     objects = UniqueFeedManager()
 
     MAX_BACKOFF = 10  # Approx. 24 hours
-    UPDATE_PERIOD = 60  # in minutes
+    UPDATE_PERIOD = 60  # in minutes, default update interval
+    MIN_UPDATE_INTERVAL = 15
+    MAX_UPDATE_INTERVAL = 60 * 24
     BACKOFF_EXPONENT = 1.5
     TIMEOUT_BASE = 20
 
@@ -429,6 +656,32 @@ class UniqueFeed(models.Model):
             return u'%s' % self.title
         return u'%s' % self.url
 
+    def save(self, *args, **kwargs):
+        if kwargs.get('update_fields') is not None:
+            super(UniqueFeed, self).save(*args, **kwargs)
+            save_state(self.url, **dict((field, getattr(self, field))
+                                        for field in kwargs['update_fields']))
+            return
+        self.next_update = self.schedule(
+            self.last_update, self.update_interval, self.backoff_factor)
+        super(UniqueFeed, self).save(*args, **kwargs)
+        save_state(self.url, **self.fetch_state())
+        if self.muted:
+            unschedule_feeds([self.url])
+        else:
+            schedule_feed(self.url, self.next_update)
+
+    @classmethod
+    def schedule(cls, last_update, update_interval, backoff_factor):
+        """
+        Date of the next update given the last one. The period grows with
+        the backoff factor.
+        """
+        if update_interval is None:
+            update_interval = cls.UPDATE_PERIOD
+        return last_update + datetime.timedelta(
+            minutes=update_interval * backoff_factor ** cls.BACKOFF_EXPONENT)
+
     def backoff(self):
         self.backoff_factor = min(self.MAX_BACKOFF, self.backoff_factor + 1)
 
@@ -436,6 +689,34 @@ class UniqueFeed(models.Model):
     def request_timeout(self):
         return 10 * self.backoff_factor
 
+    @property
+    def job_timeout(self):
+        return self.TIMEOUT_BASE * self.backoff_factor
+
+    def fetch_state(self):
+        """Values mirrored in redis for update jobs, see ``state.py``"""
+        return dict((field, getattr(self, field)) for field in STATE_FIELDS)
+
+    @classmethod
+    def state_kwargs(cls, state):
+        """Keyword arguments for the ``update_feed`` task"""
+        return {
+            'etag': state['etag'],
+            'last_modified': state['modified'],
+            'subscribers': state['subscribers'],
+            'request_timeout': 10 * state['backoff_factor'],
+            'backoff_factor': state['backoff_factor'],
+            'error': state['error'],
+            'link': state['link'],
+            'title': state['title'],
+            'hub': state['hub'],
+            'content_hash': state['content_hash'],
+            'update_interval': state['update_interval'],
+        }
+
+    def update_kwargs(self):
+        return self.state_kwargs(self.fetch_state())
+
 
 class Feed(models.Model):
     """A URL and some extra stuff"""
@@ -453,6 +734,8 @@ class Feed(models.Model):
                                 storage=OverwritingStorage())
     img_safe = models.BooleanField(_('Display images by default'),
                                    default=False)
+    newest_entry_date = models.DateTimeField(_('Newest entry date'),
+                                             null=True, blank=True)
 
     def __unicode__(self):
         return u'%s' % self.name
@@ -469,15 +752,14 @@ class Feed(models.Model):
         # FIXME maybe find another way to ensure consistency
         unique, created = UniqueFeed.objects.get_or_create(url=self.url)
         if feed_created or created:
-            enqueue(update_feed, kwargs={
-                'url': self.url,
-                'subscribers': unique.subscribers,
-                'request_timeout': unique.backoff_factor * 10,
-                'backoff_factor': unique.backoff_factor,
-                'error': unique.error,
-                'link': unique.link,
-                'title': unique.title,
-                'hub': unique.hub,
+            # No conditional request: the new subscriber needs the entries
+            # even if the feed hasn't changed. Not deduplicated, an update
+            # already in the queue would send the stored conditional state.
+            enqueue(update_feed, args=[self.url], kwargs={
+                'etag': None,
+                'last_modified': None,
+                'content_hash': None,
+                'claimed': False,
             }, queue='high', timeout=20)
             if not settings.TESTS:
                 enqueue_favicon(unique.link)
@@ -493,6 +775,10 @@ class Feed(models.Model):
             '<img src="{0}" width="16" height="16" />', self.favicon.url)
 
     def update_unread_count(self):
+        """
+        Recomputes the unread count. Counts are maintained incrementally, this
+        is only needed to repair them, see ``reconcile_unread_counts``.
+        """
         self.unread_count = self.entries.filter(read=False).count()
         self.save(update_fields=['unread_count'])
 
@@ -505,21 +791,314 @@ class Feed(models.Model):
         return COLORS[index][0]
 
 
+# Bump when the sanitizing rules change, contents processed with an older
+# version are sanitized on display until ``sanitize_contents`` runs.
+SANITIZER_VERSION = 1
+
+SANITIZE_ELEMENTS = (
+    feedparser._HTMLSanitizer.acceptable_elements |
+    feedparser._HTMLSanitizer.mathml_elements |
+    feedparser._HTMLSanitizer.svg_elements
+)
+SANITIZE_ATTRIBUTES = (
+    feedparser._HTMLSanitizer.acceptable_attributes |
+    feedparser._HTMLSanitizer.mathml_attributes |
+    feedparser._HTMLSanitizer.svg_attributes
+)
+SANITIZE_CSS_PROPERTIES = feedparser._HTMLSanitizer.acceptable_css_properties
+
+
+def absolutize(html, base_url):
+    """Makes the links of ``html`` absolute"""
+    if not html:
+        return html
+    xml = lxml.html.fromstring(html)
+    xml.make_links_absolute(base_url)
+    return lxml.html.tostring(xml)
+
+
+def sanitize(html, media=True):
+    elements = SANITIZE_ELEMENTS
+    if not media:
+        elements = elements - set(['img', 'audio', 'video'])
+    return bleach.clean(html, tags=elements, attributes=SANITIZE_ATTRIBUTES,
+                        styles=SANITIZE_CSS_PROPERTIES, strip=True)
+
+
+# Fields only needed for display
+CONTENT_DISPLAY_FIELDS = ('subtitle', 'sanitized', 'sanitized_nomedia')
+
+
+class EntryContentManager(models.Manager):
+    def for_subtitles(self, subtitles):
+        """
+        Returns a dict of subtitle -> EntryContent, creating the missing
+        contents. Identical bodies are stored once. ``subtitles`` is a dict
+        of subtitle -> URL of the feed, the base URL for sanitizing new
+        contents.
+        """
+        digests = dict((EntryContent.digest_for(subtitle), subtitle)
+                       for subtitle in subtitles)
+        contents = dict((content.digest, content) for content in self.filter(
+            digest__in=digests.keys()).defer(*CONTENT_DISPLAY_FIELDS))
+        missing = []
+        for digest, subtitle in digests.items():
+            if digest not in contents:
+                content = EntryContent(digest=digest, subtitle=subtitle)
+                content.sanitize(subtitles[subtitle])
+                missing.append(content)
+        if missing:
+            sid = transaction.savepoint()
+            try:
+                self.bulk_create(missing)
+            except IntegrityError:
+                # Created concurrently by another store job
+                transaction.savepoint_rollback(sid)
+                for content in missing:
+                    self.get_or_create(digest=content.digest, defaults=dict(
+                        (field, getattr(content, field))
+                        for field in CONTENT_DISPLAY_FIELDS + (
+                            'base_url', 'sanitizer_version')))
+            else:
+                transaction.savepoint_commit(sid)
+            contents.update((content.digest, content) for content in
+                            self.filter(digest__in=[
+                                c.digest for c in missing]).defer(
+                                    *CONTENT_DISPLAY_FIELDS))
+        return dict((subtitle, contents[digest])
+                    for digest, subtitle in digests.items())
+
+
+class EntryContent(models.Model):
+    """
+    Body of an entry, shared by all the subscribers of a feed instead of
+    being copied into each of their entries.
+
+    Both sanitized versions are computed when the content is stored, for
+    links relative to ``base_url``.
+    """
+    digest = models.CharField(_('Digest'), max_length=40, unique=True)
+    subtitle = models.TextField(_('Abstract'))
+    base_url = URLField(_('Base URL'), blank=True)
+    sanitized = models.TextField(_('Sanitized abstract'), blank=True)
+    sanitized_nomedia = models.TextField(
+        _('Sanitized abstract without media'), blank=True)
+    sanitizer_version = models.PositiveSmallIntegerField(
+        _('Sanitizer version'), default=0)
+
+    objects = EntryContentManager()
+
+    def __unicode__(self):
+        return u'%s' % self.digest
+
+    @classmethod
+    def digest_for(cls, subtitle):
+        if isinstance(subtitle, unicode):
+            subtitle = subtitle.encode('utf-8')
+        return hashlib.sha1(subtitle).hexdigest()
+
+    def sanitize(self, base_url):
+        content = absolutize(self.subtitle, base_url)
+        self.base_url = base_url
+        self.sanitized = sanitize(content)
+        self.sanitized_nomedia = sanitize(content, media=False)
+        self.sanitizer_version = SANITIZER_VERSION
+
+
+# Inserts entries unless the feed already has an item with the same link or
+# guid and adds them to the unread counts of their feeds. Lookups go through
+# the link and guid hashes. A partial unique index on (feed_id, guid_hash)
+# catches concurrent inserts, see migrations 0019 and 0020.
+ENTRY_INSERT = """
+    WITH inserted AS (
+        INSERT INTO feeds_entry (
+            user_id, feed_id, title, subtitle, shared_content_id, link, author,
+            date, guid, link_hash, guid_hash, read, read_later_url, starred,
+            broadcast
+        )
+        SELECT
+            v.user_id, v.feed_id, v.title, '', v.content_id, v.link, v.author,
+            v.date, v.guid, v.link_hash, v.guid_hash, false, '', false, false
+        FROM (VALUES {values}) AS v (
+            user_id, feed_id, title, content_id, link, author, date, guid,
+            link_hash, guid_hash
+        )
+        WHERE NOT EXISTS (
+            SELECT 1 FROM feeds_entry e
+            WHERE e.feed_id = v.feed_id AND (
+                (e.link_hash = v.link_hash AND e.link = v.link) OR (
+                    v.guid != '' AND e.guid != '' AND
+                    e.guid_hash = v.guid_hash AND e.guid = v.guid
+                )
+            )
+        )
+        RETURNING id, feed_id, date
+    ), counts AS (
+        SELECT feed_id, count(*) AS created, array_agg(id) AS ids,
+            max(date) AS newest
+        FROM inserted GROUP BY feed_id
+    )
+    UPDATE feeds_feed SET unread_count = unread_count + counts.created,
+        newest_entry_date = greatest(newest_entry_date, counts.newest)
+    FROM counts WHERE feeds_feed.id = counts.feed_id
+    RETURNING feeds_feed.id, feeds_feed.user_id, counts.created, counts.ids
+"""
+# Updates the feed of an entry created outside of ``EntryManager.store``.
+ENTRY_CREATED = """
+    UPDATE feeds_feed SET unread_count = unread_count + %s,
+        newest_entry_date = greatest(newest_entry_date, %s)
+    WHERE id = %s
+"""
+ENTRY_VALUES = ("(%s::integer, %s::integer, %s::text, %s::integer, %s::text, "
+                "%s::text, %s::timestamptz, %s::text, %s::bigint, %s::bigint)")
+
+# SQL version of ``Entry.hash_for``
+URL_HASH = "('x' || substr(md5({0}), 1, 16))::bit(64)::bigint"
+ENTRY_INSERT_CHUNK = 500
+
+# Changes the read state of entries and updates the unread counts of their
+# feeds by the number of entries that actually changed.
+SET_READ = """
+    WITH changed AS (
+        UPDATE feeds_entry SET read = %s
+        WHERE read = %s AND id IN ({entries})
+        RETURNING id, feed_id
+    ), counts AS (
+        SELECT feed_id, count(*) AS changed, array_agg(id) AS ids
+        FROM changed GROUP BY feed_id
+    )
+    UPDATE feeds_feed
+    SET unread_count = greatest(0, unread_count + counts.changed * %s)
+    FROM counts WHERE feeds_feed.id = counts.feed_id
+    RETURNING feeds_feed.user_id, counts.changed, counts.ids
+"""
+
+
 class EntryManager(models.Manager):
     def unread(self):
         return self.filter(read=False).count()
 
+    def store(self, feeds, entries):
+        """
+        Creates ``entries`` (dicts of entry fields) for each of ``feeds``
+        (dicts with ``pk``, ``user_id`` and ``url`` keys). Items a feed
+        already has, with the same link or guid, are skipped by the database.
+
+        Unread counts are incremented in the same statement. Returns a dict of
+        feed pk -> number of entries created.
+        """
+        return self.store_many([(feeds, entries)])
+
+    def store_many(self, batches):
+        """
+        Batch version of ``store``: ``batches`` is a list of ``(feeds,
+        entries)`` tuples, written with a single content lookup and bulk
+        insert.
+        """
+        batches = [(feeds, self.unique_entries(entries))
+                   for feeds, entries in batches]
+
+        # Bodies are stored once, whatever the number of subscribers
+        contents = EntryContent.objects.for_subtitles(dict(
+            (entry['subtitle'], feeds[0]['url'])
+            for feeds, entries in batches if feeds
+            for entry in entries if entry.get('subtitle')))
+
+        rows = []
+        for feeds, entries in batches:
+            for feed in feeds:
+                for entry in entries:
+                    content = contents.get(entry.get('subtitle'))
+                    rows.append([
+                        feed['user_id'], feed['pk'], entry['title'],
+                        content.pk if content is not None else None,
+                        entry['link'], entry.get('author', ''),
+                        entry['date'], entry['guid'],
+                        Entry.hash_for(entry['link']),
+                        Entry.hash_for(entry['guid']),
+                    ])
+
+        created = defaultdict(int)
+        new_ids = defaultdict(list)
+        cursor = connection.cursor()
+        for index in range(0, len(rows), ENTRY_INSERT_CHUNK):
+            chunk = rows[index:index + ENTRY_INSERT_CHUNK]
+            query = ENTRY_INSERT.format(
+                values=', '.join([ENTRY_VALUES] * len(chunk)))
+            params = [value for row in chunk for value in row]
+            sid = transaction.savepoint()
+            try:
+                cursor.execute(query, params)
+            except IntegrityError:
+                # Another job stored the same items concurrently, they are
+                # visible now.
+                transaction.savepoint_rollback(sid)
+                cursor.execute(query, params)
+            else:
+                transaction.savepoint_commit(sid)
+            for feed_id, user_id, count, ids in cursor.fetchall():
+                created[feed_id] += count
+                new_ids[user_id].extend(ids)
+        transaction.commit_unless_managed()
+        record_changes(dict((user_id, [item_change('new', ids)])
+                            for user_id, ids in new_ids.items()))
+        return dict(created)
+
+    @staticmethod
+    def unique_entries(entries):
+        """Drops the items that repeat the link or guid of a previous one"""
+        unique = []
+        links, guids = set(), set()
+        for entry in entries:
+            if entry['link'] in links or (entry['guid'] and
+                                          entry['guid'] in guids):
+                continue
+            links.add(entry['link'])
+            guids.add(entry['guid'])
+            unique.append(entry)
+        return unique
+
+    def set_read(self, entries, read=True):
+        """
+        Marks the ``entries`` queryset as read or unread and updates the
+        unread counts of their feeds by delta, atomically. Returns the number
+        of entries that changed state.
+        """
+        query, params = entries.order_by().values('pk').query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute(SET_READ.format(entries=query),
+                       [read, not read] + list(params) + [-1 if read else 1])
+        rows = cursor.fetchall()
+        transaction.commit_unless_managed()
+        changed = defaultdict(list)
+        for user_id, count, ids in rows:
+            changed[user_id].extend(ids)
+        record_changes(dict(
+            (user_id, [item_change('read' if read else 'unread', ids)])
+            for user_id, ids in changed.items()))
+        return sum([count for user_id, count, ids in rows])
+
 
 class Entry(models.Model):
     """An entry is a cached feed item"""
     feed = models.ForeignKey(Feed, verbose_name=_('Feed'), null=True,
                              blank=True, related_name='entries')
     title = models.CharField(_('Title'), max_length=255)
-    subtitle = models.TextField(_('Abstract'))
-    link = URLField(_('URL'), db_index=True)
+    # Entries stored from feeds point to a shared content, the body of other
+    # entries is stored inline. Use the ``subtitle`` property.
+    inline_subtitle = models.TextField(_('Abstract'), db_column='subtitle',
+                                       blank=True)
+    shared_content = models.ForeignKey(
+        EntryContent, verbose_name=_('Content'), null=True, blank=True,
+        related_name='entries')
+    link = URLField(_('URL'))
     author = models.CharField(_('Author'), max_length=1023, blank=True)
     date = models.DateTimeField(_('Date'), db_index=True)
-    guid = URLField(_('GUID'), db_index=True, blank=True)
+    guid = URLField(_('GUID'), blank=True)
+    # Fixed-width digests of link and guid, indexed with the feed for
+    # deduplication. Set on save, see ``hash_for``.
+    link_hash = models.BigIntegerField(_('Link hash'), null=True, blank=True)
+    guid_hash = models.BigIntegerField(_('GUID hash'), null=True, blank=True)
     # The User FK is redundant but this may be better for performance and if
     # want to allow user input.
     user = models.ForeignKey(User, verbose_name=(_('User')),
@@ -539,21 +1118,55 @@ class Entry(models.Model):
         ordering = ('-date', '-id')
         verbose_name_plural = 'entries'
 
-    ELEMENTS = (
-        feedparser._HTMLSanitizer.acceptable_elements |
-        feedparser._HTMLSanitizer.mathml_elements |
-        feedparser._HTMLSanitizer.svg_elements
-    )
-    ATTRIBUTES = (
-        feedparser._HTMLSanitizer.acceptable_attributes |
-        feedparser._HTMLSanitizer.mathml_attributes |
-        feedparser._HTMLSanitizer.svg_attributes
-    )
-    CSS_PROPERTIES = feedparser._HTMLSanitizer.acceptable_css_properties
+    ELEMENTS = SANITIZE_ELEMENTS
+    ATTRIBUTES = SANITIZE_ATTRIBUTES
+    CSS_PROPERTIES = SANITIZE_CSS_PROPERTIES
+
+    # States logged as item changes when they change
+    STATES = ('read', 'starred', 'broadcast')
+
+    def __init__(self, *args, **kwargs):
+        super(Entry, self).__init__(*args, **kwargs)
+        self._saved_states = self.states()
 
     def __unicode__(self):
         return u'%s' % self.title
 
+    def states(self):
+        # Deferred fields aren't loaded, they can't have changed
+        return dict((state, self.__dict__.get(state))
+                    for state in self.STATES)
+
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        self.link_hash = self.hash_for(self.link)
+        self.guid_hash = self.hash_for(self.guid)
+        super(Entry, self).save(*args, **kwargs)
+        if created and self.feed_id is not None:
+            connection.cursor().execute(ENTRY_CREATED, [
+                0 if self.read else 1, self.date, self.feed_id])
+        states = self.states()
+        if created:
+            bump_version(self.user_id, item_change('new', [self.pk]))
+        else:
+            bump_version(self.user_id, *[
+                item_change(state if value else 'un' + state, [self.pk])
+                for state, value in states.items()
+                if value != self._saved_states[state]])
+        self._saved_states = states
+
+    @classmethod
+    def hash_for(cls, value):
+        """
+        First 64 bits of the MD5 digest of ``value``, as a signed integer.
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        number = int(hashlib.md5(value).hexdigest()[:16], 16)
+        if number >= 2 ** 63:
+            number -= 2 ** 64
+        return number
+
     @property
     def hex_pk(self):
         value = hex(struct.unpack("L", struct.pack("l", self.pk))[0])
@@ -561,6 +1174,17 @@ class Entry(models.Model):
             value = value[:-1]
         return value[2:].zfill(16)
 
+    @property
+    def subtitle(self):
+        if self.shared_content_id is not None:
+            return self.shared_content.subtitle
+        return self.inline_subtitle
+
+    @subtitle.setter
+    def subtitle(self, value):
+        self.shared_content = None
+        self.inline_subtitle = value
+
     def sanitized_title(self):
         if self.title:
             return unescape_entities(bleach.clean(self.title, tags=[],
@@ -570,31 +1194,32 @@ class Entry(models.Model):
     @property
     def content(self):
         if not hasattr(self, '_content'):
-            if self.subtitle:
-                xml = lxml.html.fromstring(self.subtitle)
-                xml.make_links_absolute(self.feed.url)
-                self._content = lxml.html.tostring(xml)
-            else:
-                self._content = self.subtitle
+            self._content = absolutize(self.subtitle, self.feed.url)
         return self._content
 
+    def sanitized_shared_content(self):
+        """
+        The shared content, if it was sanitized by the current sanitizer for
+        this entry's feed.
+        """
+        if self.shared_content_id is None:
+            return
+        content = self.shared_content
+        if (content.sanitizer_version == SANITIZER_VERSION and
+                content.base_url == self.feed.url):
+            return content
+
     def sanitized_content(self):
-        return bleach.clean(
-            self.content,
-            tags=self.ELEMENTS,
-            attributes=self.ATTRIBUTES,
-            styles=self.CSS_PROPERTIES,
-            strip=True,
-        )
+        content = self.sanitized_shared_content()
+        if content is not None:
+            return content.sanitized
+        return sanitize(self.content)
 
     def sanitized_nomedia_content(self):
-        return bleach.clean(
-            self.content,
-            tags=self.ELEMENTS - set(['img', 'audio', 'video']),
-            attributes=self.ATTRIBUTES,
-            styles=self.CSS_PROPERTIES,
-            strip=True,
-        )
+        content = self.sanitized_shared_content()
+        if content is not None:
+            return content.sanitized_nomedia
+        return sanitize(self.content, media=False)
 
     def get_absolute_url(self):
         return reverse('feeds:item', args=[self.id])
@@ -671,10 +1296,35 @@ def pubsubhubbub_update(notification, **kwargs):
         [UniqueFeedManager.entry_data(
             entry, notification) for entry in notification.entries]
     )
-    enqueue(store_entries, args=[url, entries], queue='store')
+    queue_entries(url, entries)
 updated.connect(pubsubhubbub_update)
 
 
+def category_changed(sender, instance, **kwargs):
+    bump_version(instance.user_id, {'t': 'tags'})
+models.signals.post_save.connect(category_changed, sender=Category)
+models.signals.post_delete.connect(category_changed, sender=Category)
+
+
+def feed_saved(sender, instance, created, update_fields=None, **kwargs):
+    stream = u'feed/{0}'.format(instance.url)
+    if created:
+        bump_version(instance.user_id, {'t': 'subscribe', 's': stream})
+    elif update_fields is not None and set(update_fields) <= set([
+            'unread_count', 'img_safe']):
+        # Not part of the subscription
+        bump_version(instance.user_id)
+    else:
+        bump_version(instance.user_id, {'t': 'edit', 's': stream})
+models.signals.post_save.connect(feed_saved, sender=Feed)
+
+
+def feed_deleted(sender, instance, **kwargs):
+    bump_version(instance.user_id, {'t': 'unsubscribe',
+                                    's': u'feed/{0}'.format(instance.url)})
+models.signals.post_delete.connect(feed_deleted, sender=Feed)
+
+
 class FaviconManager(models.Manager):
     def update_favicon(self, link, force_update=False):
         if not link:
@@ -702,7 +1352,7 @@ class FaviconManager(models.Manager):
         ua = {'User-Agent': FAVICON_FETCHER}
 
         try:
-            page = requests.get(link, headers=ua, timeout=10).content
+            page = session_pool.get(link, headers=ua, timeout=10).content
         except requests.RequestException:
             return favicon
         except LocationParseError:
@@ -725,7 +1375,8 @@ class FaviconManager(models.Manager):
             parsed[3] = parsed[4] = parsed[5] = ''
             icon_path = [urlparse.urlunparse(parsed)]
         try:
-            response = requests.get(icon_path[0], headers=ua, timeout=10)
+            response = session_pool.get(icon_path[0], headers=ua,
+                                        timeout=10)
         except requests.RequestException:
             return favicon
         if response.status_code != 200:
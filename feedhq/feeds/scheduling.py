@@ -0,0 +1,300 @@
+"""
+Host-aware helpers for dispatching feed updates.
+
+Many feeds live on a handful of hosts (feedburner, blogspot, wordpress.com).
+Hitting one of them with hundreds of requests in the same second gets us
+throttled, so updates are interleaved by host, capped per host and skipped
+for hosts that recently asked us to slow down.
+
+Due dates are also mirrored in a redis sorted set (feed URL -> timestamp of
+the next update) for the ``scheduler`` daemon.
+"""
+import calendar
+import datetime
+import email.utils
+import logging
+import math
+import threading
+import time
+import urlparse
+
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from itertools import izip_longest
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from ..tasks import claim_many, enqueue_many, queue_length, redis_connection
+from .tasks import update_feed, update_feeds, update_marker
+
+logger = logging.getLogger('feedupdater')
+
+THROTTLE_DEFAULT = 600  # seconds, when the host doesn't say
+THROTTLE_MIN = 60
+THROTTLE_MAX = 3600
+
+SCHEDULE_KEY = 'feeds:schedule'
+SCHEDULE_CHUNK = 1000  # members per ZADD/ZREM command
+
+ENQUEUED_KEY = 'feeds:enqueued'  # update jobs ever enqueued
+QUEUE_STATS_KEY = 'feeds:queue_stats'
+QUEUE_STATS_TIMEOUT = 3600
+
+
+def feed_host(url):
+    return urlparse.urlparse(url).netloc.lower()
+
+
+def interleave(feeds, max_per_host=None, url=lambda feed: feed.url):
+    """
+    Round-robins over ``feeds`` by host so that consecutive jobs hit
+    different hosts. Returns a (scheduled, deferred) tuple: ``deferred``
+    contains the feeds above ``max_per_host`` for a given host.
+    """
+    by_host = OrderedDict()
+    for feed in feeds:
+        by_host.setdefault(feed_host(url(feed)), []).append(feed)
+
+    deferred = []
+    if max_per_host:
+        for host, host_feeds in by_host.items():
+            deferred.extend(host_feeds[max_per_host:])
+            by_host[host] = host_feeds[:max_per_host]
+
+    scheduled = []
+    for feeds in izip_longest(*by_host.values()):
+        scheduled.extend([feed for feed in feeds if feed is not None])
+    return scheduled, deferred
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header (delay in seconds or HTTP date) into a
+    bounded number of seconds.
+    """
+    seconds = THROTTLE_DEFAULT
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            seconds = int(value)
+        else:
+            parsed = email.utils.parsedate_tz(value)
+            if parsed is not None:
+                timestamp = email.utils.mktime_tz(parsed)
+                now = datetime.datetime.utcnow()
+                delta = datetime.datetime.utcfromtimestamp(timestamp) - now
+                seconds = delta.days * 86400 + delta.seconds
+    return max(THROTTLE_MIN, min(THROTTLE_MAX, seconds))
+
+
+def throttle_key(host):
+    return 'throttled_host:{0}'.format(host)
+
+
+def throttle_host(host, seconds):
+    cache.set(throttle_key(host), 1, seconds)
+
+
+def throttled_hosts(hosts):
+    keys = dict((throttle_key(host), host) for host in hosts)
+    return set([keys[key] for key in cache.get_many(keys.keys())])
+
+
+class HostLimiter(object):
+    """
+    Caps the number of in-flight requests per host across threads.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = defaultdict(
+            lambda: threading.BoundedSemaphore(self.limit))
+
+    @contextmanager
+    def __call__(self, url):
+        with self.lock:
+            semaphore = self.semaphores[feed_host(url)]
+        with semaphore:
+            yield
+
+
+def timestamp(date):
+    return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+def schedule_feeds(dates):
+    """
+    Sets the due dates of several feeds. ``dates`` is a dict of URL ->
+    datetime.
+    """
+    dates = dates.items()
+    conn = redis_connection()
+    for index in range(0, len(dates), SCHEDULE_CHUNK):
+        args = []
+        for url, date in dates[index:index + SCHEDULE_CHUNK]:
+            args.extend([url, timestamp(date)])
+        conn.zadd(SCHEDULE_KEY, *args)
+
+
+def schedule_feed(url, date):
+    schedule_feeds({url: date})
+
+
+def unschedule_feeds(urls):
+    conn = redis_connection()
+    for index in range(0, len(urls), SCHEDULE_CHUNK):
+        conn.zrem(SCHEDULE_KEY, *urls[index:index + SCHEDULE_CHUNK])
+
+
+def scheduled_feeds():
+    return set(redis_connection().zrange(SCHEDULE_KEY, 0, -1))
+
+
+def pop_due_feeds(count, now=None):
+    """
+    Removes and returns the URLs of up to ``count`` due feeds. Several
+    processes can safely pop concurrently: a URL is only returned to the
+    process that removed it.
+    """
+    if now is None:
+        now = timezone.now()
+    conn = redis_connection()
+    urls = conn.zrangebyscore(SCHEDULE_KEY, '-inf', timestamp(now),
+                              start=0, num=count)
+    if not urls:
+        return []
+    pipe = conn.pipeline()
+    for url in urls:
+        pipe.zrem(SCHEDULE_KEY, url)
+    return [url for url, removed in zip(urls, pipe.execute()) if removed]
+
+
+def next_due_in(now=None):
+    """
+    Number of seconds until the next feed is due, None if nothing is
+    scheduled.
+    """
+    if now is None:
+        now = timezone.now()
+    first = redis_connection().zrange(SCHEDULE_KEY, 0, 0, withscores=True)
+    if not first:
+        return None
+    return max(0, first[0][1] - timestamp(now))
+
+
+def schedule_lag(now=None):
+    """
+    How far behind schedule feeds are: returns the number of due feeds and
+    the number of seconds since the oldest due date.
+    """
+    if now is None:
+        now = timezone.now()
+    conn = redis_connection()
+    now = timestamp(now)
+    due = conn.zcount(SCHEDULE_KEY, '-inf', now)
+    if not due:
+        return 0, 0
+    oldest = conn.zrange(SCHEDULE_KEY, 0, 0, withscores=True)
+    return due, max(0, int(now - oldest[0][1]))
+
+
+def backpressure(wanted):
+    """
+    Number of feeds that can be enqueued, at most ``wanted``, without
+    growing the default queue beyond ``FETCH_QUEUE_TARGET`` jobs.
+
+    Also logs the queue length, the rate at which workers process jobs since
+    the previous call and how far behind schedule feeds are.
+    """
+    depth = queue_length()
+    enqueued = int(redis_connection().get(ENQUEUED_KEY) or 0)
+    now = time.time()
+    previous = cache.get(QUEUE_STATS_KEY)
+    cache.set(QUEUE_STATS_KEY, {'time': now, 'depth': depth,
+                                'enqueued': enqueued}, QUEUE_STATS_TIMEOUT)
+
+    rate = 'unknown'
+    if previous is not None and now > previous['time']:
+        processed = (previous['depth'] + enqueued - previous['enqueued'] -
+                     depth)
+        rate = '{0:.1f}'.format(max(0, processed) / (now - previous['time']))
+
+    room = max(0, settings.FETCH_QUEUE_TARGET - depth)
+    allowed = min(wanted, room * max(1, settings.FETCH_BATCH_SIZE))
+    due, lag = schedule_lag()
+    message = ("Queue: {0} jobs, {1} jobs/s. {2} feeds due, {3}s behind "
+               "schedule. Enqueueing {4}/{5} feeds".format(
+                   depth, rate, due, lag, allowed, wanted))
+    if allowed < wanted:
+        logger.info(message)
+    else:
+        logger.debug(message)
+    return allowed
+
+
+def batch_timeout(uniques):
+    """
+    Timeout of a batch job fetching ``uniques``. Fetches run
+    ``FETCH_CONCURRENCY`` at a time and ``FETCH_HOST_CONCURRENCY`` at a time
+    per host, so a batch dominated by a single host takes more rounds.
+    """
+    hosts = defaultdict(int)
+    for unique in uniques:
+        hosts[feed_host(unique.url)] += 1
+    rounds = max([
+        int(math.ceil(len(uniques) / float(settings.FETCH_CONCURRENCY))),
+    ] + [int(math.ceil(count / float(settings.FETCH_HOST_CONCURRENCY)))
+         for count in hosts.values()])
+    return max([0] + [u.job_timeout for u in uniques]) * rounds
+
+
+def enqueue_updates(uniques, queued):
+    """
+    Enqueues update jobs for a list of UniqueFeed instances, interleaved by
+    host and batched according to ``FETCH_BATCH_SIZE``, in a single pipeline.
+    The primary keys of enqueued feeds are added to ``queued`` once jobs are
+    created. Feeds that already have an update job in the queue are not
+    enqueued again but count as queued.
+
+    Returns the feeds that weren't enqueued: throttled hosts or above the
+    per-host limit.
+    """
+    throttled = throttled_hosts(set([feed_host(u.url) for u in uniques]))
+    allowed = [u for u in uniques if feed_host(u.url) not in throttled]
+    deferred = [u for u in uniques if feed_host(u.url) in throttled]
+    uniques, limited = interleave(allowed,
+                                  max_per_host=settings.FETCH_HOST_LIMIT)
+    deferred.extend(limited)
+    if deferred:
+        logger.debug("Deferred {0} feeds, {1} hosts throttled".format(
+            len(deferred), len(throttled)))
+
+    batch_size = settings.FETCH_BATCH_SIZE
+    if batch_size > 1:
+        # Markers outlive the slowest possible batch: a single host
+        longest = int(math.ceil(min(batch_size, len(uniques)) / float(
+            min(settings.FETCH_CONCURRENCY, settings.FETCH_HOST_CONCURRENCY))))
+        claimed = claim_many([update_marker(u.url) for u in uniques],
+                             update_feed.__name__,
+                             max([0] + [u.job_timeout for u in uniques]) *
+                             longest)
+        fresh = [u for u, ok in zip(uniques, claimed) if ok]
+        batches = [fresh[index:index + batch_size]
+                   for index in range(0, len(fresh), batch_size)]
+        jobs = [{
+            'function': update_feeds,
+            'args': [[unique.url for unique in batch]],
+            'timeout': batch_timeout(batch),
+        } for batch in batches]
+    else:
+        jobs = [{
+            'function': update_feed,
+            'args': [unique.url],
+            'timeout': unique.job_timeout,
+            'unique_key': update_marker(unique.url),
+        } for unique in uniques]
+    redis_connection().incr(ENQUEUED_KEY, enqueue_many(jobs))
+    queued.update([unique.pk for unique in uniques])
+    return deferred
@@ -0,0 +1,105 @@
+"""
+Keep-alive HTTP sessions for feed and favicon fetches.
+
+``requests.get`` builds a new session for every call, which means a new DNS
+lookup, TCP and TLS handshake for each feed, even when hundreds of them live
+on the same host. Sessions are kept here per worker process, keyed by scheme
+and host.
+
+A session is shared by all the feeds of its host and by the worker threads,
+so sessions don't keep cookies: one feed's cookies must not be sent along
+with another feed's requests.
+"""
+import cookielib
+import logging
+import requests
+import threading
+import time
+import urlparse
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger('feedupdater')
+
+
+class NoCookiePolicy(cookielib.DefaultCookiePolicy):
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class SessionPool(object):
+    """
+    Size-bounded pool of ``requests`` sessions, one per host. Least recently
+    used sessions are closed when the pool is full, and sessions that haven't
+    been used for ``max_idle`` seconds are closed on the next access.
+    """
+    def __init__(self, max_size=200, max_idle=300):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.sessions = OrderedDict()  # key -> (session, last used)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, url):
+        parsed = urlparse.urlparse(url)
+        return parsed.scheme.lower(), parsed.netloc.lower()
+
+    def session(self, url):
+        key = self.key(url)
+        now = time.time()
+        with self.lock:
+            self.evict_idle(now)
+            if key in self.sessions:
+                session, last_used = self.sessions.pop(key)
+                self.hits += 1
+            else:
+                session = requests.Session()
+                session.cookies.set_policy(NoCookiePolicy())
+                self.misses += 1
+                while len(self.sessions) >= self.max_size:
+                    self.evict(self.sessions.keys()[0])
+            # Re-inserting keeps the dict ordered by last use
+            self.sessions[key] = (session, now)
+        return session
+
+    def evict(self, key):
+        session, last_used = self.sessions.pop(key)
+        session.close()
+        self.evictions += 1
+
+    def evict_idle(self, now):
+        for key, (session, last_used) in self.sessions.items():
+            if last_used > now - self.max_idle:
+                break
+            self.evict(key)
+
+    def get(self, url, **kwargs):
+        if settings.TESTS:
+            # Make sure requests.get is properly mocked during tests
+            if str(type(requests.get)) != "<class 'mock.MagicMock'>":
+                raise ValueError("Not Mocked")
+            return requests.get(url, **kwargs)
+        return self.session(url).get(url, **kwargs)
+
+    def clear(self):
+        with self.lock:
+            for key in self.sessions.keys():
+                self.evict(key)
+
+    def stats(self):
+        return {
+            'size': len(self.sessions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+session_pool = SessionPool()
@@ -0,0 +1,67 @@
+"""
+Fetch state of feeds (conditional GET headers, backoff factor, ...) mirrored
+in redis.
+
+Update jobs only carry a feed URL and read the state when they run, which
+keeps jobs small and avoids sending outdated conditional headers when a job
+waited in the queue. Each feed has a hash of JSON-encoded UniqueFeed field
+values, written by every code path that changes them.
+"""
+import hashlib
+import json
+
+from ..tasks import redis_connection
+
+STATE_FIELDS = ('etag', 'modified', 'subscribers', 'backoff_factor', 'error',
+                'link', 'title', 'hub', 'content_hash', 'update_interval')
+STATE_CHUNK = 1000  # keys per DEL command
+
+
+def state_key(url):
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return 'feed_state:{0}'.format(hashlib.sha1(url).hexdigest())
+
+
+def save_states(states):
+    """
+    Updates the state of several feeds. ``states`` is a dict of URL -> dict
+    of field values, fields that aren't part of the state are ignored.
+    """
+    pipe = redis_connection().pipeline(transaction=False)
+    for url, fields in states.items():
+        values = dict((field, json.dumps(value))
+                      for field, value in fields.items()
+                      if field in STATE_FIELDS)
+        if values:
+            pipe.hmset(state_key(url), values)
+    pipe.execute()
+
+
+def save_state(url, **fields):
+    save_states({url: fields})
+
+
+def get_states(urls):
+    """
+    Returns the states of ``urls``, in the same order. The state is None
+    for feeds that don't have a complete state in redis.
+    """
+    pipe = redis_connection().pipeline(transaction=False)
+    for url in urls:
+        pipe.hgetall(state_key(url))
+    states = []
+    for values in pipe.execute():
+        if len(values) < len(STATE_FIELDS):
+            states.append(None)
+        else:
+            states.append(dict((field, json.loads(value))
+                               for field, value in values.items()))
+    return states
+
+
+def delete_states(urls):
+    keys = [state_key(url) for url in urls]
+    conn = redis_connection()
+    for index in range(0, len(keys), STATE_CHUNK):
+        conn.delete(*keys[index:index + STATE_CHUNK])
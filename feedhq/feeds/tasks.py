@@ -1,29 +1,130 @@
+import hashlib
 import json
 import logging
+import math
+import time
+import uuid
+import zlib
 
 from collections import defaultdict
 
-from django.db.models import Q
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
 from django_push.subscriber.models import Subscription
 from rq.timeouts import JobTimeoutException
 
-from ..tasks import enqueue
+from ..tasks import enqueue, redis_connection, release
 
 logger = logging.getLogger('feedupdater')
 
+# Coalescing store queue: entry payloads waiting to be stored, and in-flight
+# marker of the job that drains them.
+STORE_QUEUE_KEY = 'store:pending'
+STORE_MARKER = 'store:drain'
+# Payloads taken by a drain job stay in a processing list of the job until
+# they are stored. Processing lists are registered in a sorted set scored by
+# creation time, the ones older than STORE_RECOVERY_DELAY belong to jobs that
+# died and are put back in the queue.
+STORE_PROCESSING_KEY = 'store:processing'
+STORE_RECOVERY_DELAY = 600
+# Payloads of feeds that can't be stored, kept for inspection
+STORE_FAILED_KEY = 'store:failed'
 
-def update_feed(url, etag=None, last_modified=None, subscribers=1,
-                request_timeout=10, backoff_factor=1, error=None, link=None,
-                title=None, hub=None):
+# Moves up to ARGV[1] payloads from the head of the queue to a processing list
+TAKE_SCRIPT = """
+local payloads = redis.call('lrange', KEYS[1], 0, ARGV[1] - 1)
+if #payloads > 0 then
+    redis.call('ltrim', KEYS[1], #payloads, -1)
+    redis.call('rpush', KEYS[2], unpack(payloads))
+end
+return payloads
+"""
+
+# Puts the payloads of a processing list back at the head of the queue
+RESTORE_SCRIPT = """
+local payloads = redis.call('lrange', KEYS[1], 0, -1)
+for i = #payloads, 1, -1 do
+    redis.call('lpush', KEYS[2], payloads[i])
+end
+redis.call('del', KEYS[1])
+return #payloads
+"""
+
+# Serialized size above which the entries of a feed are split across several
+# payloads.
+PAYLOAD_SIZE = 256 * 1024
+
+
+def update_marker(url):
+    """
+    In-flight marker of a feed update: set when the job is enqueued,
+    released once it has run.
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return 'update_feed:{0}'.format(hashlib.sha1(url).hexdigest())
+
+
+def update_feed(url, claimed=True, **kwargs):
+    """
+    Fetches a feed. Jobs only carry the URL, the fetch state is loaded when
+    the job runs. ``kwargs`` take the keys of ``UniqueFeed.update_kwargs()``
+    and override the stored state.
+
+    Jobs enqueued without the in-flight marker pass ``claimed=False`` and
+    leave it to the job holding it.
+    """
     from .models import UniqueFeed
     try:
-        UniqueFeed.objects.update_feed(
-            url, etag=etag, last_modified=last_modified,
-            subscribers=subscribers, request_timeout=request_timeout,
-            backoff_factor=backoff_factor, previous_error=error, link=link,
-            title=title, hub=hub)
+        state = UniqueFeed.objects.load_update_kwargs([url]).get(url)
+        if state is None and not kwargs:
+            logger.debug("Not updating deleted feed {0}".format(url))
+            return
+        state = state or {}
+        state.update(kwargs)
+        state['previous_error'] = state.pop('error', None)
+        UniqueFeed.objects.update_feed(url, **state)
     except JobTimeoutException:
         enqueue(backoff_feed, args=[url], queue='store')
+    finally:
+        if claimed:
+            release(update_marker(url))
+
+
+def update_feeds(feeds):
+    """
+    Batch version of ``update_feed``, fetched concurrently by a single
+    worker. ``feeds`` is a list of URLs, or of dicts of ``update_feed``
+    keyword arguments with a ``url`` key.
+    """
+    from .models import UniqueFeed
+    feeds = [feed if isinstance(feed, dict) else {'url': feed}
+             for feed in feeds]
+    pending = set([feed['url'] for feed in feeds])
+
+    def done(url):
+        pending.discard(url)
+        release(update_marker(url))
+
+    try:
+        states = UniqueFeed.objects.load_update_kwargs(list(pending))
+        batch = []
+        for feed in feeds:
+            if feed['url'] in states or len(feed) > 1:
+                kwargs = states.get(feed['url'], {})
+                kwargs.update(feed)
+                batch.append(kwargs)
+            else:
+                logger.debug("Not updating deleted feed {0}".format(
+                    feed['url']))
+                done(feed['url'])
+        UniqueFeed.objects.update_feeds(batch, callback=done)
+    except JobTimeoutException:
+        for url in pending:
+            enqueue(backoff_feed, args=[url], queue='store')
+    finally:
+        release(*[update_marker(url) for url in pending])
 
 
 def backoff_feed(url):
@@ -51,38 +152,155 @@ def subscribe(topic_url, hub_url):
 
 
 def store_entries(feed_url, entries, json_format=False):
+    """
+    Stores new entries for all the subscribers of ``feed_url``. Returns the
+    pks of the feeds that got new entries.
+    """
     from .models import Entry, Feed
     if json_format:
         entries = json.loads(entries)
-    links = set([entry['link'] for entry in entries])
-    guids = set([entry['guid'] for entry in entries])
-    query = Q(feed__url=feed_url) & (Q(link__in=links) | Q(guid__in=guids))
-    existing = Entry.objects.filter(query).values('link', 'guid', 'feed_id')
-    existing_links = defaultdict(set)
-    existing_guids = defaultdict(set)
-    for entry in existing:
-        existing_links[entry['feed_id']].add(entry['link'])
-        if entry['guid']:
-            existing_guids[entry['feed_id']].add(entry['guid'])
-
-    feeds = Feed.objects.filter(url=feed_url).values('pk', 'user_id')
-
-    create = []
-    update_unread_counts = set()
-    for feed in feeds:
-        for entry in entries:
-            if (
-                entry['link'] in existing_links[feed['pk']] or
-                entry['guid'] in existing_guids[feed['pk']]
-            ):
-                continue
-            create.append(Entry(user_id=feed['user_id'],
-                                feed_id=feed['pk'], **entry))
-            update_unread_counts.add(feed['pk'])
-
-    if create:
-        Entry.objects.bulk_create(create)
-
-    for pk in update_unread_counts:
-        Feed.objects.filter(pk=pk).update(
-            unread_count=Entry.objects.filter(feed_id=pk, read=False).count())
+
+    feeds = Feed.objects.filter(url=feed_url).values('pk', 'user_id', 'url')
+    return set(Entry.objects.store(list(feeds), entries))
+
+
+def encode_payloads(feed_url, entries):
+    """
+    Serializes entries for the store queue: compressed JSON, split in
+    payloads of about ``PAYLOAD_SIZE`` bytes before compression so that large
+    feeds don't produce huge redis values.
+    """
+    queued = time.time()
+    chunks, chunk, size = [], [], 0
+    for entry in entries:
+        length = len(json.dumps(entry, cls=DjangoJSONEncoder))
+        if chunk and size + length > PAYLOAD_SIZE:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(entry)
+        size += length
+    if chunk:
+        chunks.append(chunk)
+    return [zlib.compress(json.dumps(
+        {'url': feed_url, 'entries': chunk, 'queued': queued},
+        cls=DjangoJSONEncoder, separators=(',', ':'))) for chunk in chunks]
+
+
+def decode_payload(payload):
+    return json.loads(zlib.decompress(payload))
+
+
+def queue_entries(feed_url, entries):
+    """
+    Puts entries in the store queue. Payloads of many feeds are written
+    together by ``store_pending``, a single drain job is queued at a time.
+    """
+    payloads = encode_payloads(feed_url, entries)
+    if not payloads:
+        return
+    redis_connection().rpush(STORE_QUEUE_KEY, *payloads)
+    enqueue(store_pending, queue='store', unique_key=STORE_MARKER)
+
+
+def pop_payloads(size, max_delay, processing):
+    """
+    Moves up to ``size`` payloads from the store queue to the ``processing``
+    list. When the queue holds less, waits for more until the oldest payload
+    is ``max_delay`` seconds old.
+    """
+    conn = redis_connection()
+    payloads = []
+    while len(payloads) < size:
+        taken = conn.eval(TAKE_SCRIPT, 2, STORE_QUEUE_KEY, processing,
+                          size - len(payloads))
+        payloads.extend([decode_payload(payload) for payload in taken])
+        if not payloads or len(payloads) >= size:
+            break
+        wait = int(math.ceil(payloads[0]['queued'] + max_delay - time.time()))
+        if wait <= 0:
+            break
+        popped = conn.brpoplpush(STORE_QUEUE_KEY, processing, timeout=wait)
+        if popped is None:
+            break
+        payloads.append(decode_payload(popped))
+    return payloads
+
+
+def recover_payloads():
+    """
+    Puts back in the queue the payloads of drain jobs that died before
+    storing them. Returns the number of payloads recovered.
+    """
+    conn = redis_connection()
+    recovered = 0
+    for processing in conn.zrangebyscore(
+            STORE_PROCESSING_KEY, '-inf', time.time() - STORE_RECOVERY_DELAY):
+        recovered += conn.eval(RESTORE_SCRIPT, 2, processing, STORE_QUEUE_KEY)
+        conn.zrem(STORE_PROCESSING_KEY, processing)
+    if recovered:
+        logger.warning("Recovered {0} payloads".format(recovered))
+    return recovered
+
+
+def store_pending():
+    """
+    Drains the store queue: stores the entries of up to
+    ``settings.STORE_BATCH_SIZE`` payloads at once.
+    """
+    # Payloads queued from now on need another job
+    release(STORE_MARKER)
+    recover_payloads()
+    conn = redis_connection()
+    processing = 'store:processing:{0}'.format(uuid.uuid4().hex)
+    conn.zadd(STORE_PROCESSING_KEY, processing, time.time())
+    try:
+        payloads = pop_payloads(settings.STORE_BATCH_SIZE,
+                                settings.STORE_MAX_DELAY, processing)
+        if payloads:
+            store_payloads(payloads)
+    except Exception:
+        # Stored by the next drain job
+        conn.eval(RESTORE_SCRIPT, 2, processing, STORE_QUEUE_KEY)
+        raise
+    finally:
+        conn.delete(processing)
+        conn.zrem(STORE_PROCESSING_KEY, processing)
+
+    if conn.llen(STORE_QUEUE_KEY):
+        enqueue(store_pending, queue='store', unique_key=STORE_MARKER)
+
+
+def store_payloads(payloads):
+    """
+    Stores the entries of ``payloads``, falling back to one feed at a time
+    when the batch fails. Entries of feeds that still fail are queued in
+    ``STORE_FAILED_KEY``.
+    """
+    from .models import Entry, Feed
+
+    entries = defaultdict(list)
+    for payload in payloads:
+        entries[payload['url']].extend(payload['entries'])
+    feeds = defaultdict(list)
+    for feed in Feed.objects.filter(url__in=entries.keys()).values(
+            'pk', 'user_id', 'url'):
+        feeds[feed['url']].append(feed)
+
+    try:
+        Entry.objects.store_many([(feeds[url], items)
+                                  for url, items in entries.items()])
+    except Exception:
+        transaction.rollback_unless_managed()
+        logger.exception("Failed to store {0} payloads, storing them "
+                         "separately".format(len(payloads)))
+        for url, items in entries.items():
+            try:
+                Entry.objects.store(feeds[url], items)
+            except Exception:
+                transaction.rollback_unless_managed()
+                logger.exception("Failed to store entries of {0}".format(url))
+                redis_connection().rpush(STORE_FAILED_KEY,
+                                         *encode_payloads(url, items))
+    else:
+        logger.debug("Stored {0} payloads for {1} feeds".format(
+            len(payloads), len(entries)))
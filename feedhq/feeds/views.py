@@ -88,15 +88,7 @@ def entries_list(request, page=1, only_unread=False, category=None, feed=None):
     if request.method == "POST":
         form = ReadForm(data=request.POST)
         if form.is_valid():
-            count = entries.filter(read=False).count()
-            entries.update(read=True)
-            if feed is not None:
-                feeds = Feed.objects.filter(pk=feed.pk)
-            elif category is not None:
-                feeds = category.feeds.all()
-            else:
-                feeds = user.feeds.all()
-            feeds.update(unread_count=0)
+            count = Entry.objects.set_read(entries, True)
             messages.success(request,
                              _('%s entries have been marked as read' % count))
             if only_unread:
@@ -272,13 +264,12 @@ delete_feed = login_required(DeleteFeed.as_view())
 @login_required
 def item(request, entry_id):
     qs = Entry.objects.filter(user=request.user).select_related(
-        'feed', 'feed__category',
+        'feed', 'feed__category', 'shared_content',
     )
     entry = get_object_or_404(qs, pk=entry_id)
     if not entry.read:
+        Entry.objects.set_read(qs.filter(pk=entry.pk), True)
         entry.read = True
-        entry.save(update_fields=['read'])
-        entry.feed.update_unread_count()
 
     back_url = request.session.get('back_url',
                                    default=entry.feed.get_absolute_url())
@@ -351,9 +342,7 @@ def item(request, entry_id):
                     entry.feed.img_safe = True
                     entry.feed.save(update_fields=['img_safe'])
             elif action == 'unread':
-                entry.read = False
-                entry.save(update_fields=['read'])
-                entry.feed.update_unread_count()
+                Entry.objects.set_read(qs.filter(pk=entry.pk), False)
                 return redirect(back_url)
             elif action == 'read_later':
                 enqueue(read_later, args=[entry.pk], timeout=20, queue='high')
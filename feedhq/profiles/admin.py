@@ -15,9 +15,9 @@ class ProfileUserAdmin(UserAdmin):
     form = ProfileUserChangeForm
     fieldsets = UserAdmin.fieldsets + (
         (_('FeedHQ'), {'fields': ('timezone', 'entries_per_page',
-                                  'read_later', 'read_later_credentials',
-                                  'sharing_twitter', 'sharing_gplus',
-                                  'sharing_email')}),
+                                  'retention_days', 'read_later',
+                                  'read_later_credentials', 'sharing_twitter',
+                                  'sharing_gplus', 'sharing_email')}),
     )
 
 
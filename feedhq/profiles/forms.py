@@ -24,7 +24,8 @@ class ProfileForm(forms.ModelForm):
 
     class Meta:
         model = User
-        fields = ['username', 'timezone', 'entries_per_page']
+        fields = ['username', 'timezone', 'entries_per_page',
+                  'retention_days']
 
     def clean_username(self):
         username = self.cleaned_data['username']
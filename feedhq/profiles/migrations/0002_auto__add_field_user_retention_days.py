@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'User.retention_days'
+        db.add_column(u'auth_user', 'retention_days',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(default=0),
+                      keep_default=False)
+
+    def backwards(self, orm):
+        # Deleting field 'User.retention_days'
+        db.delete_column(u'auth_user', 'retention_days')
+
+    models = {
+        
+    }
+
+    complete_apps = ['profiles']
@@ -16,6 +16,14 @@ ENTRIES_PER_PAGE = (
     (100, 100),
 )
 
+# Number of days read entries are kept, 0 uses settings.ENTRY_RETENTION_DAYS
+RETENTION_DAYS = (
+    (0, _('Site default')),
+    (30, _('1 month')),
+    (90, _('3 months')),
+    (365, _('1 year')),
+)
+
 
 class User(models.Model):
     NONE = ''
@@ -34,6 +42,8 @@ class User(models.Model):
                                 choices=TIMEZONES, default='UTC')
     entries_per_page = models.IntegerField(_('Entries per page'), default=50,
                                            choices=ENTRIES_PER_PAGE)
+    retention_days = models.PositiveIntegerField(
+        _('Keep read entries for'), default=0, choices=RETENTION_DAYS)
     read_later = models.CharField(_('Read later service'), blank=True,
                                   choices=READ_LATER_SERVICES, max_length=50)
     read_later_credentials = models.TextField(_('Read later credentials'),
@@ -13,3 +13,8 @@ class PermissionDenied(ReaderException):
 class BadToken(ReaderException):
     status_code = status.HTTP_401_UNAUTHORIZED
     detail = 'Invalid POST token'
+
+
+class NotModified(ReaderException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+    detail = ''
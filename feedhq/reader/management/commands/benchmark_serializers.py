@@ -0,0 +1,125 @@
+import time
+
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import RequestFactory
+from django.utils.xmlutils import SimplerXMLGenerator
+from rest_framework.compat import StringIO
+from rest_framework.renderers import JSONRenderer
+
+from ...renderers import GoogleReaderXMLRenderer
+from ...views import ITEM_FIELDS, ItemSerializer, get_unique_map, label_key
+
+
+def legacy_serialize(request, entry, uniques):
+    """The model-based item serializer ``ItemSerializer`` replaced."""
+    item = {
+        "crawlTimeMsec": entry.date.strftime("%s000"),
+        "timestampUsec": entry.date.strftime("%s000000"),
+        "id": "tag:google.com,2005:reader/item/{0}".format(entry.hex_pk),
+        "categories": ["user/{0}/state/com.google/reading-list".format(
+            request.user.pk)],
+        "title": entry.title,
+        "published": int(entry.date.strftime("%s")),
+        "updated": int(entry.date.strftime("%s")),
+        "alternate": [{
+            "href": entry.link,
+            "type": "text/html",
+        }],
+        "content": {
+            "direction": "ltr",
+            "content": entry.subtitle,
+        },
+        "origin": {
+            "streamId": "feed/{0}".format(entry.feed.url),
+            "title": entry.feed.name,
+            "htmlUrl": uniques[entry.feed.url].link,
+        },
+    }
+    if entry.feed.category is not None:
+        item['categories'].append(label_key(request, entry.feed.category))
+    for state in ['read', 'starred', 'broadcast']:
+        if getattr(entry, state):
+            item['categories'].append(
+                "user/{0}/state/com.google/{1}".format(request.user.pk,
+                                                       state))
+    return item
+
+
+class LegacyXMLRenderer(GoogleReaderXMLRenderer):
+    """Renders through ``SimplerXMLGenerator``, as before ``XMLWriter``."""
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        stream = StringIO()
+        xml = SimplerXMLGenerator(stream, "utf-8")
+        xml.startDocument()
+        self._to_xml(xml, data)
+        xml.endDocument()
+        response = stream.getvalue()
+        declaration = '<?xml version="1.0" encoding="utf-8"?>'
+        if response.startswith(declaration):
+            response = response[len(declaration):]
+        return response.strip()
+
+
+class Command(BaseCommand):
+    """Compares the model-based and row-based item serialization paths.
+
+    Serializes the latest entries of a user both ways, checks that both
+    produce the same payload and prints the best time of each step."""
+    args = '<username>'
+    option_list = BaseCommand.option_list + (
+        make_option('--n', action='store', type='int', dest='n',
+                    default=1000, help='Number of items per payload'),
+        make_option('--rounds', action='store', type='int', dest='rounds',
+                    default=5, help='Number of runs, the best one is kept'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: benchmark_serializers <username>")
+        try:
+            user = User.objects.get(username=args[0])
+        except User.DoesNotExist:
+            raise CommandError("Unknown user: {0}".format(args[0]))
+        request = RequestFactory().get('/')
+        request.user = user
+        uniques = get_unique_map(user, force=True)
+        n = options['n']
+
+        def legacy():
+            entries = user.entries.select_related(
+                'feed', 'feed__category', 'shared_content')[:n]
+            return {'items': [legacy_serialize(request, entry, uniques)
+                              for entry in entries]}
+
+        def rows():
+            serialize = ItemSerializer(request, uniques)
+            return {'items': [serialize(row) for row in
+                              user.entries.values(*ITEM_FIELDS)[:n]]}
+
+        old, new = legacy(), rows()
+        if old != new:
+            self.stderr.write("Payloads differ!")
+        self.stdout.write("{0} items".format(len(new['items'])))
+
+        for step, old_path, new_path in (
+            ('query + serialize', legacy, rows),
+            ('json', lambda: JSONRenderer().render(old),
+             lambda: JSONRenderer().render(new)),
+            ('xml', lambda: LegacyXMLRenderer().render(old),
+             lambda: GoogleReaderXMLRenderer().render(new)),
+        ):
+            before = self.best(old_path, options['rounds'])
+            after = self.best(new_path, options['rounds'])
+            self.stdout.write("{0:<20} {1:8.1f}ms {2:8.1f}ms  x{3:.1f}".format(
+                step, before * 1000, after * 1000, before / after))
+
+    def best(self, function, rounds):
+        timings = []
+        for i in range(rounds):
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+        return min(timings)
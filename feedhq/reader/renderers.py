@@ -1,8 +1,13 @@
 import datetime
+import itertools
+import json
 
-from django.utils.xmlutils import SimplerXMLGenerator
-from rest_framework.compat import StringIO
-from rest_framework.renderers import BaseRenderer, XMLRenderer
+from xml.sax.saxutils import escape, quoteattr
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer, XMLRenderer
+
+# Number of items rendered between two chunks of a streamed response
+STREAM_CHUNK_ITEMS = 50
 
 
 def timestamp_to_iso(value):
@@ -10,6 +15,83 @@ def timestamp_to_iso(value):
         value).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
+class ItemStream(object):
+    """
+    Lazy list of items. Responses with an ``ItemStream`` in their data are
+    streamed: renderers write the items as they are produced, followed by the
+    keys of ``trailer``, which is filled while iterating.
+    """
+    def __init__(self, items, trailer=None):
+        self.items = items
+        self.trailer = {} if trailer is None else trailer
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def map(self, function):
+        return ItemStream(itertools.imap(function, self.items), self.trailer)
+
+
+def is_streamed(data):
+    return isinstance(data, dict) and any([
+        isinstance(value, ItemStream) for value in data.values()])
+
+
+def split_streams(data):
+    """
+    Splits a dict into its regular items and its ``ItemStream`` items.
+    """
+    regular, streams = {}, []
+    for key, value in data.items():
+        if isinstance(value, ItemStream):
+            streams.append((key, value))
+        else:
+            regular[key] = value
+    return regular, streams
+
+
+class XMLWriter(object):
+    """
+    Drop-in replacement for the parts of ``SimplerXMLGenerator`` the renderers
+    use, producing the same output. Chunks are collected in a list and
+    encoded once instead of going through a text stream on every call.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.chunks = []
+        self.write = self.chunks.append
+
+    def startDocument(self):
+        self.write(u'<?xml version="1.0" encoding="%s"?>\n' % self.encoding)
+
+    def endDocument(self):
+        pass
+
+    def startElement(self, name, attrs):
+        self.write(u'<' + name)
+        for key, value in attrs.items():
+            self.write(u' %s=%s' % (key, quoteattr(value)))
+        self.write(u'>')
+
+    def endElement(self, name):
+        self.write(u'</%s>' % name)
+
+    def characters(self, content):
+        if not isinstance(content, unicode):
+            content = unicode(content, self.encoding)
+        self.write(escape(content))
+
+    def getvalue(self):
+        return u''.join(self.chunks).encode(self.encoding,
+                                            'xmlcharrefreplace')
+
+    def flush(self):
+        """Returns the output written since the last flush."""
+        value = self.getvalue()
+        del self.chunks[:]
+        return value
+
+
 class PlainRenderer(BaseRenderer):
     media_type = 'text/plain'
     format = '*'
@@ -20,6 +102,33 @@ class PlainRenderer(BaseRenderer):
         return data
 
 
+class StreamingJSONRenderer(JSONRenderer):
+    def stream(self, data):
+        """
+        Yields ``data`` as JSON in chunks, ``ItemStream`` values item by item.
+        """
+        regular, streams = split_streams(data)
+        chunk = [json.dumps(regular, cls=self.encoder_class)[:-1]]
+        separator = ', ' if regular else ''
+        for key, items in streams:
+            chunk.append('{0}{1}: ['.format(separator, json.dumps(key)))
+            for index, item in enumerate(items):
+                if index:
+                    chunk.append(', ')
+                chunk.append(json.dumps(item, cls=self.encoder_class))
+                if index % STREAM_CHUNK_ITEMS == STREAM_CHUNK_ITEMS - 1:
+                    yield ''.join(chunk)
+                    chunk = []
+            chunk.append(']')
+            for name, value in items.trailer.items():
+                chunk.append(', {0}: {1}'.format(
+                    json.dumps(name), json.dumps(value,
+                                                 cls=self.encoder_class)))
+            separator = ', '
+        chunk.append('}')
+        yield ''.join(chunk)
+
+
 class BaseXMLRenderer(XMLRenderer):
     strip_declaration = True
 
@@ -27,14 +136,13 @@ class BaseXMLRenderer(XMLRenderer):
         if data is None:
             return ''
 
-        stream = StringIO()
-        xml = SimplerXMLGenerator(stream, "utf-8")
+        xml = XMLWriter("utf-8")
         xml.startDocument()
 
         self._to_xml(xml, data)
 
         xml.endDocument()
-        response = stream.getvalue()
+        response = xml.getvalue()
 
         if self.strip_declaration:
             declaration = '<?xml version="1.0" encoding="utf-8"?>'
@@ -51,25 +159,7 @@ class GoogleReaderXMLRenderer(BaseXMLRenderer):
         if isinstance(data, dict) and data:
             xml.startElement("object", {})
             for key, value in data.items():
-                if isinstance(value, basestring) and value.isdigit():
-                    value = int(value)
-                if isinstance(value, (list, tuple)):
-                    xml.startElement("list", {'name': key})
-                    for item in value:
-                        self._to_xml(xml, item)
-                    xml.endElement("list")
-                elif isinstance(value, int):
-                    xml.startElement("number", {'name': key})
-                    xml.characters(str(value))
-                    xml.endElement("number")
-                elif isinstance(value, basestring):
-                    xml.startElement("string", {'name': key})
-                    xml.characters(value)
-                    xml.endElement("string")
-                elif isinstance(value, dict):
-                    xml.startElement("object", {'name': key})
-                    self._to_xml(xml, value)
-                    xml.endElement("object")
+                self._value_to_xml(xml, key, value)
             xml.endElement("object")
         elif data == {}:
             pass
@@ -80,6 +170,48 @@ class GoogleReaderXMLRenderer(BaseXMLRenderer):
         else:  # Unhandled case
             assert False, data
 
+    def _value_to_xml(self, xml, key, value):
+        if isinstance(value, basestring) and value.isdigit():
+            value = int(value)
+        if isinstance(value, (list, tuple)):
+            xml.startElement("list", {'name': key})
+            for item in value:
+                self._to_xml(xml, item)
+            xml.endElement("list")
+        elif isinstance(value, int):
+            xml.startElement("number", {'name': key})
+            xml.characters(str(value))
+            xml.endElement("number")
+        elif isinstance(value, basestring):
+            xml.startElement("string", {'name': key})
+            xml.characters(value)
+            xml.endElement("string")
+        elif isinstance(value, dict):
+            xml.startElement("object", {'name': key})
+            self._to_xml(xml, value)
+            xml.endElement("object")
+
+    def stream(self, data):
+        """
+        Yields ``data`` as XML in chunks, ``ItemStream`` values item by item.
+        """
+        regular, streams = split_streams(data)
+        xml = XMLWriter("utf-8")
+        xml.startElement("object", {})
+        for key, value in regular.items():
+            self._value_to_xml(xml, key, value)
+        for key, items in streams:
+            xml.startElement("list", {'name': key})
+            for index, item in enumerate(items):
+                self._to_xml(xml, item)
+                if index % STREAM_CHUNK_ITEMS == STREAM_CHUNK_ITEMS - 1:
+                    yield xml.flush()
+            xml.endElement("list")
+            for key, value in items.trailer.items():
+                self._value_to_xml(xml, key, value)
+        xml.endElement("object")
+        yield xml.flush()
+
 
 class AtomRenderer(BaseXMLRenderer):
     media_type = 'text/xml'
@@ -92,6 +224,24 @@ class AtomRenderer(BaseXMLRenderer):
             xml.characters(data['detail'])
             xml.endElement('error')
             return
+        for entry in self._feed_to_xml(xml, data):
+            pass
+
+    def stream(self, data):
+        """
+        Yields the feed in chunks, written as entries are produced.
+        """
+        xml = XMLWriter("utf-8")
+        xml.startDocument()
+        for index, entry in enumerate(self._feed_to_xml(xml, data)):
+            if index % STREAM_CHUNK_ITEMS == STREAM_CHUNK_ITEMS - 1:
+                yield xml.flush()
+        yield xml.flush()
+
+    def _feed_to_xml(self, xml, data):
+        """
+        Writes the feed, yielding after each entry.
+        """
         xml.startElement('feed', {
             'xmlns:media': 'http://search.yahoo.com/mrss/',
             'xmlns:gr': 'http://www.google.com/schemas/reader/atom/',
@@ -187,6 +337,7 @@ class AtomRenderer(BaseXMLRenderer):
             xml.endElement('source')
 
             xml.endElement('entry')
+            yield entry
 
         xml.endElement('feed')
 
@@ -1,37 +1,53 @@
+import base64
+import calendar
 import datetime
 import json
 import logging
 import struct
 import urlparse
+import uuid
 
 from urllib import urlencode
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.validators import email_re
-from django.db.models import Max, Sum, Min, Q
-from django.http import Http404
+from django.db import connections
+from django.db.backends.postgresql_psycopg2.base import utc_tzinfo_factory
+from django.db.models import Min, Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.http import (Http404, HttpResponseNotModified,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 
 from rest_framework import exceptions
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.negotiation import DefaultContentNegotiation
-from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from ..feeds.changes import (bump_version, changes_since, item_change,
+                             user_epoch_version, user_version)
 from ..feeds.forms import FeedForm
-from ..feeds.models import Feed, UniqueFeed, Category
+from ..feeds.models import Entry, UniqueFeed, Category
 from .authentication import GoogleLoginAuthentication
-from .exceptions import PermissionDenied, BadToken
+from .exceptions import PermissionDenied, BadToken, NotModified
 from .models import generate_auth_token, generate_post_token, check_post_token
 from .renderers import (PlainRenderer, GoogleReaderXMLRenderer, AtomRenderer,
-                        AtomHifiRenderer)
+                        AtomHifiRenderer, ItemStream, StreamingJSONRenderer,
+                        is_streamed)
 
 
 logger = logging.getLogger(__name__)
 
+# Unread counts are cached under the user's version, old versions expire
+UNREAD_COUNTS_TIMEOUT = 60 * 60 * 24
+# Rows fetched per round trip when streaming entries
+STREAM_FETCH_SIZE = 500
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
 
 def item_id(value):
     """
@@ -140,12 +156,22 @@ login = Login.as_view()
 class ReaderView(APIView):
     authentication_classes = [SessionAuthentication,
                               GoogleLoginAuthentication]
-    renderer_classes = [JSONRenderer, GoogleReaderXMLRenderer]
+    renderer_classes = [StreamingJSONRenderer, GoogleReaderXMLRenderer]
     content_negotiation_class = ForceNegotiation
     require_post_token = True
+    # Responses only depend on the user's data: GET requests get an ETag
+    # from the user's change version.
+    versioned = False
 
     def initial(self, request, *args, **kwargs):
         super(ReaderView, self).initial(request, *args, **kwargs)
+        if request.method == 'GET' and self.versioned:
+            self.epoch, self.version = user_epoch_version(request.user.pk)
+            etag = '"{0}-{1}-{2}"'.format(request.user.pk, self.epoch,
+                                          self.version)
+            self.headers['ETag'] = etag
+            if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                raise NotModified
         if request.method == 'POST' and self.require_post_token:
             if not 'T' in request.DATA:
                 logger.info(
@@ -157,10 +183,30 @@ class ReaderView(APIView):
                 raise BadToken
 
     def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return HttpResponseNotModified()
         if isinstance(exc, BadToken):
             self.headers['X-Reader-Google-Bad-Token'] = "true"
         return super(ReaderView, self).handle_exception(exc)
 
+    def finalize_response(self, request, response, *args, **kwargs):
+        """
+        Responses with ``ItemStream`` data are rendered chunk by chunk while
+        they are sent instead of all at once.
+        """
+        response = super(ReaderView, self).finalize_response(
+            request, response, *args, **kwargs)
+        if isinstance(response, Response) and is_streamed(response.data):
+            streamed = StreamingHttpResponse(
+                response.accepted_renderer.stream(response.data),
+                status=response.status_code,
+                content_type=response.accepted_media_type)
+            for header, value in response.items():
+                if header.lower() != 'content-type':
+                    streamed[header] = value
+            response = streamed
+        return response
+
     def label(self, value):
         if not is_label(value, self.request.user.pk):
             raise exceptions.ParseError("Unknown label: {0}".format(value))
@@ -216,49 +262,64 @@ preference_list = PreferenceList.as_view()
 
 
 class UnreadCount(ReaderView):
+    """
+    The payload only changes with the user's version, it's cached under that
+    version so that any change to the user's data invalidates it.
+    """
     http_method_names = ['get']
+    versioned = True
 
     def get(self, request, *args, **kwargs):
+        cache_key = 'reader:unread_counts:{0}:{1}:{2}'.format(
+            request.user.pk, self.epoch, self.version)
+        data = cache.get(cache_key)
+        if data is None:
+            data = {
+                "max": 1000,
+                "unreadcounts": self.unread_counts(request),
+            }
+            cache.set(cache_key, data, UNREAD_COUNTS_TIMEOUT)
+        return Response(data)
+
+    def unread_counts(self, request):
         feeds = request.user.feeds.filter(
-            unread_count__gt=0).annotate(ts=Max('entries__date'))
-        unread_counts = [{
-            "id": "feed/{0}".format(feed.url),
-            "count": feed.unread_count,
-            "newestItemTimestampUsec": feed.ts.strftime("%s000000"),
-        } for feed in feeds]
-
-        # We can't annotate with Max('feeds__entries__date') when fetching the
-        # categories since it creates duplicates and returns wrong counts.
-        cat_ts = {}
+            unread_count__gt=0).select_related('category')
+        unread_counts = []
+        categories = {}
         for feed in feeds:
-            if feed.category_id in cat_ts:
-                cat_ts[feed.category_id] = max(cat_ts[feed.category_id],
-                                               feed.ts)
-            else:
-                cat_ts[feed.category_id] = feed.ts
-        categories = request.user.categories.annotate(
-            unread_count=Sum('feeds__unread_count'),
-        ).filter(unread_count__gt=0)
+            ts = feed.newest_entry_date or EPOCH
+            unread_counts.append({
+                "id": "feed/{0}".format(feed.url),
+                "count": feed.unread_count,
+                "newestItemTimestampUsec": ts.strftime("%s000000"),
+            })
+            if feed.category is None:
+                continue
+            category, count, cat_ts = categories.get(
+                feed.category_id, (feed.category, 0, ts))
+            categories[feed.category_id] = (
+                category, count + feed.unread_count, max(cat_ts, ts))
+
+        categories = sorted(categories.values(), key=lambda item: (
+            item[0].order is None, item[0].order, item[0].name, item[0].pk))
         unread_counts += [{
             "id": label_key(request, cat),
-            "count": cat.unread_count,
-            "newestItemTimestampUsec": cat_ts[cat.pk].strftime("%s000000"),
-        } for cat in categories]
+            "count": count,
+            "newestItemTimestampUsec": ts.strftime("%s000000"),
+        } for cat, count, ts in categories]
 
         # Special items:
         # reading-list is the global counter
-        if cat_ts.values():
+        if feeds:
             unread_counts += [{
                 "id": "user/{0}/state/com.google/reading-list".format(
                     request.user.pk),
                 "count": sum([f.unread_count for f in feeds]),
-                "newestItemTimestampUsec": max(
-                    cat_ts.values()).strftime("%s000000"),
+                "newestItemTimestampUsec": max([
+                    f.newest_entry_date or EPOCH for f in feeds]).strftime(
+                        "%s000000"),
             }]
-        return Response({
-            "max": 1000,
-            "unreadcounts": unread_counts,
-        })
+        return unread_counts
 unread_count = UnreadCount.as_view()
 
 
@@ -322,6 +383,7 @@ rename_tag = RenameTag.as_view()
 
 class TagList(ReaderView):
     http_method_names = ['get']
+    versioned = True
 
     def get(self, request, *args, **kwargs):
         tags = [{
@@ -345,6 +407,7 @@ tag_list = TagList.as_view()
 
 class SubscriptionList(ReaderView):
     http_method_names = ['get']
+    versioned = True
 
     def get(self, request, *args, **kwargs):
         feeds = request.user.feeds.annotate(
@@ -429,6 +492,8 @@ class EditSubscription(ReaderView):
                 query['name'] = request.DATA['t']
             if query:
                 qs.update(**query)
+                bump_version(request.user.pk, {'t': 'edit',
+                                               's': request.DATA['s']})
         else:
             msg = "Unrecognized action: {0}".format(action)
             logger.info(msg)
@@ -581,73 +646,182 @@ def get_stream_q(streams, user_id, exclude=None, limit=None, offset=None):
     return q
 
 
-def pagination(entries, n=None, c=None):
-    # ?n=20 (default), ?c=<continuation> for offset
+def continuation_token(date, pk):
+    """
+    Opaque continuation string: the position of the last item of a page.
+    """
+    usec = calendar.timegm(date.utctimetuple()) * 10 ** 6 + date.microsecond
+    return base64.urlsafe_b64encode('{0}:{1}'.format(usec, pk)).rstrip('=')
+
+
+def parse_continuation(c):
+    try:
+        usec, pk = base64.urlsafe_b64decode(
+            str(c) + '=' * (-len(c) % 4)).split(':')
+        usec, pk = int(usec), int(pk)
+        date = datetime.datetime.utcfromtimestamp(usec // 10 ** 6).replace(
+            microsecond=usec % 10 ** 6, tzinfo=timezone.utc)
+    except (TypeError, ValueError, OverflowError, UnicodeEncodeError):
+        raise exceptions.ParseError("Invalid 'c' continuation string")
+    return date, pk
+
+
+def iter_rows(queryset, size=STREAM_FETCH_SIZE):
+    """
+    Yields the rows of a ``values()`` queryset as dicts. Rows are fetched
+    ``size`` at a time through a server-side cursor, memory use doesn't grow
+    with the number of rows.
+    """
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return
+    names = (list(queryset.extra_names) + list(queryset.field_names) +
+             list(queryset.aggregate_names))
+    connection = connections[queryset.db]
+    connection.cursor()  # Opens the connection
+    cursor = connection.connection.cursor(
+        name='stream_{0}'.format(uuid.uuid4().hex))
+    cursor.itersize = size
+    if settings.USE_TZ:
+        cursor.tzinfo_factory = utc_tzinfo_factory
+    debug = connection.use_debug_cursor
+    if debug or (debug is None and settings.DEBUG):
+        cursor = connection.make_debug_cursor(cursor)
+    try:
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield dict(zip(names, row))
+    finally:
+        cursor.close()
+
+
+def page_rows(rows, size, trailer):
+    """
+    Yields the first ``size`` rows. If there are more, the continuation to
+    the next page is set in ``trailer``.
+    """
+    last = None
+    for index, row in enumerate(rows):
+        if index == size:
+            if last is not None:
+                trailer['continuation'] = continuation_token(last['date'],
+                                                             last['pk'])
+            return
+        last = row
+        yield row
+
+
+def pagination(entries, n=None, c=None, reverse=True):
+    """
+    Returns a page of ``entries``, a ``values()`` queryset, as an
+    ``ItemStream`` of rows. Once it's consumed its trailer has the
+    continuation string to the next page, if any.
+
+    ?n=20 (default) items per page, ?c=<continuation> resumes after the last
+    item of the previous page. Entries are sorted by date and id, most recent
+    first unless ``reverse`` is False. Legacy ``pageN`` continuations are
+    still accepted.
+    """
     if n is None:
         n = 20
-    if c is None:
-        c = 'page1'
     try:
         pagination_by = int(n)
     except ValueError:
         raise exceptions.ParseError("'n' must be an integer")
-    try:
-        page = int(c[4:])
-    except ValueError:
-        raise exceptions.ParseError("Invalid 'c' continuation string")
 
-    continuation = None
-    if page * pagination_by < entries.count():
-        continuation = 'page{0}'.format(page + 1)
+    ordering = ('-date', '-id') if reverse else ('date', 'id')
+    start = 0
+    if c is not None and c.startswith('page'):
+        try:
+            page = int(c[4:])
+        except ValueError:
+            raise exceptions.ParseError("Invalid 'c' continuation string")
+        start = max(0, (page - 1) * pagination_by)
+    elif c is not None:
+        date, pk = parse_continuation(c)
+        if reverse:
+            after = Q(date__lt=date) | Q(date=date, pk__lt=pk)
+        else:
+            after = Q(date__gt=date) | Q(date=date, pk__gt=pk)
+        entries = entries.filter(after)
 
-    start = max(0, (page - 1) * pagination_by)
-    end = page * pagination_by
-    return start, end, continuation
+    # One extra row tells whether there is a next page
+    rows = iter_rows(
+        entries.order_by(*ordering)[start:start + pagination_by + 1])
+    trailer = {}
+    return ItemStream(page_rows(rows, pagination_by, trailer), trailer)
 
 
 def label_key(request, label):
     return "user/{0}/label/{1}".format(request.user.pk, label.name)
 
 
-def serialize_entry(request, entry, uniques):
-    reading_list = "user/{0}/state/com.google/reading-list".format(
-        request.user.pk)
-    read = "user/{0}/state/com.google/read".format(request.user.pk)
-    starred = "user/{0}/state/com.google/starred".format(request.user.pk)
-    broadcast = "user/{0}/state/com.google/broadcast".format(request.user.pk)
-
-    item = {
-        "crawlTimeMsec": entry.date.strftime("%s000"),
-        "timestampUsec": entry.date.strftime("%s000000"),
-        "id": "tag:google.com,2005:reader/item/{0}".format(entry.hex_pk),
-        "categories": [reading_list],
-        "title": entry.title,
-        "published": int(entry.date.strftime("%s")),
-        "updated": int(entry.date.strftime("%s")),
-        "alternate": [{
-            "href": entry.link,
-            "type": "text/html",
-        }],
-        "content": {
-            "direction": "ltr",
-            "content": entry.subtitle,
-        },
-        "origin": {
-            "streamId": "feed/{0}".format(entry.feed.url),
-            "title": entry.feed.name,
-            "htmlUrl": uniques[entry.feed.url].link,
-        },
-    }
-    if entry.feed.category is not None:
-        item['categories'].append(
-            label_key(request, entry.feed.category))
-    if entry.read:
-        item['categories'].append(read)
-    if entry.starred:
-        item['categories'].append(starred)
-    if entry.broadcast:
-        item['categories'].append(broadcast)
-    return item
+# Entry columns read by ``ItemSerializer``
+ITEM_FIELDS = ('pk', 'date', 'title', 'link', 'read', 'starred', 'broadcast',
+               'inline_subtitle', 'shared_content', 'shared_content__subtitle',
+               'feed__url', 'feed__name', 'feed__category__name')
+
+
+class ItemSerializer(object):
+    """
+    Serializes entry rows, dicts of ``ITEM_FIELDS`` as returned by
+    ``values()``, to Google Reader items. Strings that are the same for every
+    item of a request are built once.
+    """
+    def __init__(self, request, uniques):
+        self.user = request.user
+        self.uniques = uniques
+        prefix = "user/{0}/".format(self.user.pk)
+        self.reading_list = prefix + "state/com.google/reading-list"
+        self.read = prefix + "state/com.google/read"
+        self.starred = prefix + "state/com.google/starred"
+        self.broadcast = prefix + "state/com.google/broadcast"
+        self.label = prefix + "label/"
+
+    def __call__(self, row):
+        url = row['feed__url']
+        if url not in self.uniques:
+            self.uniques = get_unique_map(self.user, force=True)
+        timestamp = calendar.timegm(row['date'].utctimetuple())
+        if row['shared_content'] is not None:
+            content = row['shared_content__subtitle']
+        else:
+            content = row['inline_subtitle']
+
+        categories = [self.reading_list]
+        if row['feed__category__name'] is not None:
+            categories.append(self.label + row['feed__category__name'])
+        if row['read']:
+            categories.append(self.read)
+        if row['starred']:
+            categories.append(self.starred)
+        if row['broadcast']:
+            categories.append(self.broadcast)
+
+        return {
+            "crawlTimeMsec": "{0}000".format(timestamp),
+            "timestampUsec": "{0}000000".format(timestamp),
+            "id": "tag:google.com,2005:reader/item/{0:016x}".format(
+                row['pk'] & 0xffffffffffffffff),
+            "categories": categories,
+            "title": row['title'],
+            "published": timestamp,
+            "updated": timestamp,
+            "alternate": [{
+                "href": row['link'],
+                "type": "text/html",
+            }],
+            "content": {
+                "direction": "ltr",
+                "content": content,
+            },
+            "origin": {
+                "streamId": "feed/{0}".format(url),
+                "title": row['feed__name'],
+                "htmlUrl": self.uniques[url].link,
+            },
+        }
 
 
 def get_unique_map(user, force=False):
@@ -670,6 +844,7 @@ def get_unique_map(user, force=False):
 
 class StreamContents(ReaderView):
     http_method_names = ['get']
+    versioned = True
     renderer_classes = ReaderView.renderer_classes + [AtomRenderer,
                                                       AtomHifiRenderer]
 
@@ -685,7 +860,6 @@ class StreamContents(ReaderView):
             }],
             "author": request.user.username,
             "updated": int(timezone.now().strftime("%s")),
-            "items": [],
         }
 
         if content_id.startswith("feed/"):
@@ -739,17 +913,17 @@ class StreamContents(ReaderView):
                          exclude=request.GET.getlist('xt'),
                          limit=request.GET.get('ot'),
                          offset=request.GET.get('nt')),
-        ).select_related('feed', 'feed__category')
+        ).values(*ITEM_FIELDS)
 
         # Ordering
         # ?r=d|n last entry first (default), ?r=o oldest entry first
-        ordering = 'date' if request.GET.get('r', 'd') == 'o' else '-date'
+        reverse = request.GET.get('r', 'd') != 'o'
 
-        start, end, continuation = pagination(entries, n=request.GET.get('n'),
-                                              c=request.GET.get('c'))
+        page = pagination(entries, n=request.GET.get('n'),
+                          c=request.GET.get('c'), reverse=reverse)
 
         qs = {}
-        if start > 0:
+        if request.GET.get('c', 'page1') != 'page1':
             qs['c'] = request.GET['c']
 
         if 'output' in request.GET:
@@ -758,14 +932,7 @@ class StreamContents(ReaderView):
         if qs:
             base['self'][0]['href'] += '?{0}'.format(urlencode(qs))
 
-        if continuation:
-            base['continuation'] = continuation
-
-        for entry in entries.order_by(ordering)[start:end]:
-            if not entry.feed.url in uniques:
-                uniques = get_unique_map(request.user, force=True)
-            item = serialize_entry(request, entry, uniques)
-            base['items'].append(item)
+        base['items'] = page.map(ItemSerializer(request, uniques))
         return Response(base)
 stream_contents = StreamContents.as_view()
 
@@ -784,38 +951,89 @@ class StreamItemsIds(ReaderView):
                 request.GET['s'], request.user.pk,
                 exclude=request.GET.getlist('xt'),
                 limit=request.GET.get('ot'),
-                offset=request.GET.get('nt'))).order_by('date')
-
-        start, end, continuation = pagination(entries, n=request.GET.get('n'),
-                                              c=request.GET.get('c'))
-
-        data = {}
-        if continuation:
-            data['continuation'] = continuation
+                offset=request.GET.get('nt')))
 
         if request.GET.get("includeAllDirectStreamIds") == 'true':
             entries = entries.select_related('feed').values('pk', 'date',
                                                             'feed__url')
-            item_refs = [{
-                'id': str(e['pk']),
-                'directStreamIds': [
-                    'feed/{0}'.format(e['feed__url']),
-                ],
-                'timestampUsec': e['date'].strftime("%s000000"),
-            } for e in entries[start:end]]
         else:
             entries = entries.values('pk', 'date')
-            item_refs = [{
-                'id': str(e['pk']),
-                'directStreamIds': [],
-                'timestampUsec': e['date'].strftime("%s000000"),
-            } for e in entries[start:end]]
-        data['itemRefs'] = item_refs
-        return Response(data)
+        page = pagination(entries, n=request.GET.get('n'),
+                          c=request.GET.get('c'), reverse=False)
+        return Response({'itemRefs': page.map(lambda e: {
+            'id': str(e['pk']),
+            'directStreamIds': [
+                'feed/{0}'.format(e['feed__url']),
+            ] if 'feed__url' in e else [],
+            'timestampUsec': e['date'].strftime("%s000000"),
+        })})
     post = get
 stream_items_ids = StreamItemsIds.as_view()
 
 
+class Changes(ReaderView):
+    """
+    Incremental sync: new items, state changes and subscription changes
+    since ``?since=<cursor>``, the cursor returned by the previous call.
+    Without a cursor, or with one the change log doesn't go back to,
+    ``reset`` tells the client to sync from scratch.
+    """
+    http_method_names = ['get']
+    versioned = True
+
+    def get(self, request, *args, **kwargs):
+        since = request.GET.get('since')
+        if since is None:
+            return Response({
+                'cursor': str(user_version(request.user.pk)),
+                'reset': True,
+            })
+        try:
+            since = int(since)
+        except ValueError:
+            raise exceptions.ParseError("'since' must be a cursor")
+
+        cursor, changes = changes_since(request.user.pk, since)
+        data = {'cursor': str(cursor)}
+        if changes is None:
+            data['reset'] = True
+            return Response(data)
+
+        new = set()
+        states = {'read': {}, 'starred': {}, 'broadcast': {}}
+        subscriptions = {}
+        for change in changes:
+            kind = change['t']
+            if kind == 'new':
+                new.update(change['i'])
+            elif kind == 'tags':
+                data['tagsChanged'] = True
+            elif kind in ['subscribe', 'unsubscribe', 'edit']:
+                # Edits of new subscriptions are part of the subscription
+                if not (kind == 'edit' and
+                        subscriptions.get(change['s']) == 'subscribe'):
+                    subscriptions[change['s']] = kind
+            else:
+                value = not kind.startswith('un')
+                state = kind if value else kind[len('un'):]
+                for pk in change['i']:
+                    states[state][pk] = value
+
+        data['newItemIds'] = [str(pk) for pk in sorted(new)]
+        for state, values in states.items():
+            data['{0}ItemIds'.format(state)] = [
+                str(pk) for pk in sorted(values) if values[pk]]
+            data['un{0}ItemIds'.format(state)] = [
+                str(pk) for pk in sorted(values) if not values[pk]]
+        for kind, key in [('subscribe', 'subscribed'),
+                          ('unsubscribe', 'unsubscribed'),
+                          ('edit', 'edited')]:
+            data[key] = sorted([stream for stream, value
+                                in subscriptions.items() if value == kind])
+        return Response(data)
+changes = Changes.as_view()
+
+
 class StreamItemsCount(ReaderView):
     renderer_classes = [PlainRenderer]
 
@@ -845,28 +1063,25 @@ class StreamItemsContents(ReaderView):
 
         ids = map(item_id, items)
 
-        entries = request.user.entries.filter(pk__in=ids).select_related(
-            'feed', 'feed__category')
+        entries = list(request.user.entries.filter(pk__in=ids).values(
+            *ITEM_FIELDS))
 
         if not entries:
             raise exceptions.ParseError("No items found")
 
-        uniques = get_unique_map(request.user)
-        items = []
-        for e in entries:
-            if e.feed.url not in uniques:
-                uniques = get_unique_map(request.user, force=True)
-            items.append(serialize_entry(request, e, uniques))
+        serialize = ItemSerializer(request, get_unique_map(request.user))
+        items = [serialize(entry) for entry in entries]
+        uniques = serialize.uniques
 
         base = {
             'direction': 'ltr',
-            'id': 'feed/{0}'.format(entries[0].feed.url),
-            'title': entries[0].feed.name,
+            'id': 'feed/{0}'.format(entries[0]['feed__url']),
+            'title': entries[0]['feed__name'],
             'self': [{
                 'href': request.build_absolute_uri(),
             }],
             'alternate': [{
-                'href': uniques[entries[0].feed.url].link,
+                'href': uniques[entries[0]['feed__url']].link,
                 'type': 'text/html',
             }],
             'updated': int(timezone.now().strftime("%s")),
@@ -927,14 +1142,16 @@ class EditTag(ReaderView):
                 raise exceptions.ParseError(
                     "Unrecognized tag: {0}".format(tag))
 
-        request.user.entries.filter(pk__in=entry_ids).update(**query)
-        merged = to_add + to_remove
-        if 'read' in merged or 'kept-unread' in merged:
-            feeds = Feed.objects.filter(
-                pk__in=request.user.entries.filter(
-                    pk__in=entry_ids).values_list('feed_id', flat=True))
-            for feed in feeds:
-                feed.update_unread_count()
+        entries = request.user.entries.filter(pk__in=entry_ids)
+        if 'read' in query:
+            # Unread counts follow the read state
+            Entry.objects.set_read(entries, query.pop('read'))
+        if query:
+            ids = list(entries.values_list('pk', flat=True))
+            entries.update(**query)
+            bump_version(request.user.pk, *[
+                item_change(tag if value else 'un' + tag, ids)
+                for tag, value in query.items()])
         return Response("OK")
 edit_tag = EditTag.as_view()
 
@@ -949,28 +1166,22 @@ class MarkAllAsRead(ReaderView):
         stream = request.DATA['s']
         if stream.startswith('feed/'):
             url = stream[len('feed/'):]
-            self.request.user.entries.filter(feed__url=url).update(read=True)
-            self.request.user.feeds.filter(url=url).update(unread_count=0)
+            Entry.objects.set_read(
+                request.user.entries.filter(feed__url=url), True)
         elif is_label(stream, request.user.pk):
             name = is_label(stream, request.user.pk)
-            request.user.entries.filter(
+            Entry.objects.set_read(request.user.entries.filter(
                 feed__category=request.user.categories.get(name=name),
-            ).update(read=True)
-            request.user.categories.get(name=name).feeds.update(unread_count=0)
+            ), True)
         elif is_stream(stream, request.user.pk):
             state = is_stream(stream, request.user.pk)
             if state == 'read':  # mark read items as read yo
                 return Response("OK")
             elif state in ['kept-unread', 'reading-list']:
-                request.user.entries.update(read=True)
-                self.request.user.feeds.update(unread_count=0)
+                Entry.objects.set_read(request.user.entries.all(), True)
             elif state in ['starred', 'broadcast']:
-                entries = request.user.entries.filter(**{state: True})
-                feeds = set(entries.select_related('feed').values_list(
-                    'feed__pk', flat=True))
-                entries.update(read=True)
-                for feed in request.user.feeds.filter(pk__in=feeds):
-                    feed.update_unread_count()
+                Entry.objects.set_read(
+                    request.user.entries.filter(**{state: True}), True)
             else:
                 logger.info("Unknown state: {0}".format(state))
         else:
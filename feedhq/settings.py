@@ -173,6 +173,29 @@ CACHES = {
     },
 }
 
+# Number of feeds fetched by a single update job, and number of concurrent
+# requests within that job. A batch size of 1 disables batching.
+FETCH_BATCH_SIZE = int(os.environ.get('FETCH_BATCH_SIZE', 1))
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', 20))
+
+# Politeness: concurrent requests per host within a batch, and maximum number
+# of feeds per host queued by each updatefeeds run.
+FETCH_HOST_CONCURRENCY = int(os.environ.get('FETCH_HOST_CONCURRENCY', 2))
+FETCH_HOST_LIMIT = int(os.environ.get('FETCH_HOST_LIMIT', 500))
+
+# Backpressure: updatefeeds and the scheduler stop filling the default queue
+# when it holds more than this number of jobs.
+FETCH_QUEUE_TARGET = int(os.environ.get('FETCH_QUEUE_TARGET', 10000))
+
+# Store queue: maximum number of fetched feeds written by a single store job,
+# and maximum number of seconds a job waits for more feeds to fill a batch.
+STORE_BATCH_SIZE = int(os.environ.get('STORE_BATCH_SIZE', 100))
+STORE_MAX_DELAY = int(os.environ.get('STORE_MAX_DELAY', 2))
+
+# Number of days read entries are kept for users who haven't picked a
+# retention period. 0 keeps them forever.
+ENTRY_RETENTION_DAYS = int(os.environ.get('ENTRY_RETENTION_DAYS', 0))
+
 MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
@@ -9,7 +9,85 @@ import rq
 from django.conf import settings
 
 
-def enqueue(function, args=None, kwargs=None, timeout=None, queue='default'):
+# Time a job may wait in the queue on top of its own timeout before its
+# in-flight marker expires.
+UNIQUE_TTL = 3600
+DUPLICATES_KEY = 'rq:duplicates'
+
+CLAIM_SCRIPT = """
+if redis.call('setnx', KEYS[1], 1) == 1 then
+    redis.call('expire', KEYS[1], ARGV[1])
+    return 1
+end
+redis.call('hincrby', KEYS[2], ARGV[2], 1)
+return 0
+"""
+
+
+_pool = None
+
+# Jobs sent to redis per pipeline in enqueue_many()
+ENQUEUE_CHUNK = 500
+
+
+def redis_connection():
+    """
+    Redis client sharing a process-wide connection pool.
+    """
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool(**settings.REDIS)
+    return redis.Redis(connection_pool=_pool)
+
+
+def _claim(conn, key, name, timeout):
+    return conn.eval(CLAIM_SCRIPT, 2, key, DUPLICATES_KEY,
+                     UNIQUE_TTL + (timeout or 0), name)
+
+
+def claim(key, name, timeout=None):
+    """
+    Sets the in-flight marker ``key`` for a job. Returns False if the marker
+    is already set, in which case a duplicate is counted for ``name``.
+    """
+    return bool(_claim(redis_connection(), key, name, timeout))
+
+
+def claim_many(keys, name, timeout=None):
+    """
+    Pipelined version of ``claim``, returns a list of booleans.
+    """
+    pipe = redis_connection().pipeline(transaction=False)
+    for key in keys:
+        _claim(pipe, key, name, timeout)
+    return [bool(claimed) for claimed in pipe.execute()]
+
+
+def release(*keys):
+    if keys:
+        redis_connection().delete(*keys)
+
+
+def duplicates():
+    """Number of suppressed duplicate jobs, per job name"""
+    return dict((name, int(count)) for name, count in
+                redis_connection().hgetall(DUPLICATES_KEY).items())
+
+
+def queue_length(queue='default'):
+    return rq.Queue(queue, connection=redis_connection()).count
+
+
+def enqueue(function, args=None, kwargs=None, timeout=None, queue='default',
+            unique_key=None):
+    """
+    Puts a job in the queue. If ``unique_key`` is set, the job is only
+    enqueued if no other job holds the same key; the job itself releases it
+    when it is done.
+    """
+    if unique_key is not None and not claim(unique_key, function.__name__,
+                                            timeout):
+        return
     async = not settings.RQ_EAGER
 
     if args is None:
@@ -17,7 +95,49 @@ def enqueue(function, args=None, kwargs=None, timeout=None, queue='default'):
     if kwargs is None:
         kwargs = {}
 
-    conn = redis.Redis(**settings.REDIS)
+    conn = redis_connection()
     queue = rq.Queue(queue, connection=conn, async=async)
     return queue.enqueue_call(func=function, args=tuple(args), kwargs=kwargs,
                               timeout=timeout)
+
+
+def enqueue_many(jobs, queue='default'):
+    """
+    Puts several jobs in the same queue using pipelines instead of a
+    round-trip per job. ``jobs`` is a list of dicts of ``enqueue`` arguments:
+    ``function`` and optionally ``args``, ``kwargs``, ``timeout`` and
+    ``unique_key``.
+
+    Returns the number of jobs enqueued.
+    """
+    jobs = list(jobs)
+    unique = [job for job in jobs if job.get('unique_key') is not None]
+    if unique:
+        pipe = redis_connection().pipeline(transaction=False)
+        for job in unique:
+            _claim(pipe, job['unique_key'], job['function'].__name__,
+                   job.get('timeout'))
+        duplicate = set([id(job) for job, claimed in zip(unique,
+                                                         pipe.execute())
+                         if not claimed])
+        jobs = [job for job in jobs if id(job) not in duplicate]
+
+    if settings.RQ_EAGER:
+        for job in jobs:
+            enqueue(job['function'], args=job.get('args'),
+                    kwargs=job.get('kwargs'), timeout=job.get('timeout'),
+                    queue=queue)
+        return len(jobs)
+
+    for index in range(0, len(jobs), ENQUEUE_CHUNK):
+        # rq only issues writes when enqueueing, it can be given a pipeline
+        # as its connection.
+        pipe = redis_connection().pipeline(transaction=False)
+        rq_queue = rq.Queue(queue, connection=pipe)
+        for job in jobs[index:index + ENQUEUE_CHUNK]:
+            rq_queue.enqueue_call(func=job['function'],
+                                  args=tuple(job.get('args') or ()),
+                                  kwargs=job.get('kwargs') or {},
+                                  timeout=job.get('timeout'))
+        pipe.execute()
+    return len(jobs)
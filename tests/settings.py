@@ -13,6 +13,7 @@ PASSWORD_HASHERS = [
 ]
 
 RQ_EAGER = True
+STORE_MAX_DELAY = 0
 
 STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 
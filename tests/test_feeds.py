@@ -337,8 +337,17 @@ class WebBaseTests(WebTest):
         get.return_value = responses(200, 'sw-all.xml')
         feed = FeedFactory.create(category__user=user, user=user)
 
-        with self.assertNumQueries(3):
+        # Unchanged content: only the update is saved
+        with self.assertNumQueries(1):
             update_feed(feed.url)
+
+        # Without the content hash, entries are stored again and counted
+        stored = user.entries.count()
+        self.assertTrue(stored > 0)
+        user.entries.all().delete()
+        Feed.objects.update(unread_count=0)
+        update_feed(feed.url, content_hash=None)
+        self.assertEqual(user.entries.count(), stored)
         self.assertEqual(Feed.objects.get().unread_count,
                          user.entries.filter(read=False).count())
 
@@ -1,15 +1,26 @@
 import feedparser
+import mimetools
+import urllib2
 
+from datetime import timedelta
+from StringIO import StringIO
+
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
 from httplib import IncompleteRead
 from mock import patch
 from requests import RequestException
 from requests.packages.urllib3.exceptions import LocationParseError
 from rq.timeouts import JobTimeoutException
 
-from feedhq.feeds.models import Favicon, UniqueFeed, Feed, Entry
-from feedhq.feeds.tasks import update_feed
+from feedhq.feeds.models import (Favicon, UniqueFeed, UniqueFeedManager,
+                                 Feed, Entry)
+from feedhq.feeds.scheduling import throttled_hosts
+from feedhq.feeds.sessions import SessionPool
+from feedhq.feeds.state import get_states, save_state
+from feedhq.feeds.tasks import update_feed, update_feeds
 from feedhq.feeds.utils import FAVICON_FETCHER, USER_AGENT
 
 from .factories import FeedFactory
@@ -17,6 +28,9 @@ from .test_feeds import test_file, responses
 
 
 class UpdateTests(TestCase):
+    def tearDown(self):  # noqa
+        cache.clear()
+
     @patch("requests.get")
     def test_parse_error(self, get):
         get.side_effect = LocationParseError("Failed to parse url")
@@ -135,6 +149,8 @@ class UpdateTests(TestCase):
             self.assertFalse(feed.muted)
             self.assertEqual(feed.error, '502')
             self.assertEqual(feed.backoff_factor, min(i + 2, 10))
+            self.assertEqual(feed.next_update, UniqueFeed.schedule(
+                feed.last_update, feed.update_interval, feed.backoff_factor))
 
         get.side_effect = RequestException
         feed = UniqueFeed.objects.get()
@@ -148,6 +164,27 @@ class UpdateTests(TestCase):
             self.assertEqual(feed.error, 'timeout')
             self.assertEqual(feed.backoff_factor, min(i + 2, 10))
 
+    @patch('requests.get')
+    def test_throttling(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(url='http://example.com/throttled')
+        self.assertEqual(throttled_hosts(['example.com']), set())
+
+        get.return_value = responses(429, headers={'retry-after': '120'})
+        update_feed(feed.url)
+        unique = UniqueFeed.objects.get()
+        self.assertEqual(unique.error, UniqueFeed.THROTTLED)
+        self.assertEqual(unique.backoff_factor, 1)
+        # Due again in 2 minutes instead of an hour
+        self.assertTrue(unique.next_update < timezone.now() + timedelta(
+            minutes=3))
+        self.assertEqual(throttled_hosts(['example.com', 'example.org']),
+                         set(['example.com']))
+
+        get.return_value = responses(503, headers={'retry-after': '60'})
+        update_feed(feed.url)
+        self.assertEqual(UniqueFeed.objects.get().backoff_factor, 1)
+
     @patch("requests.get")
     def test_etag_modified(self, get):
         get.return_value = responses(304)
@@ -162,6 +199,40 @@ class UpdateTests(TestCase):
                 'If-Modified-Since': '1234',
             }, timeout=10)
 
+    @patch("requests.get")
+    def test_fetch_state(self, get):
+        get.return_value = responses(200, 'sw-all.xml', headers={
+            'Content-Type': 'text/xml', 'etag': 'abc'})
+        feed = FeedFactory.create()
+        [state] = get_states([feed.url])
+        self.assertEqual(state['etag'], 'abc')
+        self.assertEqual(state['backoff_factor'], 1)
+
+        # Jobs read the current state
+        get.return_value = responses(304)
+        save_state(feed.url, etag='def', subscribers=3)
+        update_feed(feed.url)
+        get.assert_called_with(
+            feed.url,
+            headers={
+                'User-Agent': USER_AGENT % '3 subscribers',
+                'Accept': feedparser.ACCEPT_HEADER,
+                'If-None-Match': 'def',
+            }, timeout=10)
+
+        get.return_value = responses(502)
+        update_feed(feed.url)
+        [state] = get_states([feed.url])
+        self.assertEqual(state['backoff_factor'], 2)
+        self.assertEqual(state['error'], '502')
+
+        # Deleted feeds aren't fetched
+        get.reset_mock()
+        UniqueFeed.objects.all().delete()
+        update_feed('http://example.com/deleted')
+        update_feeds(['http://example.com/deleted'])
+        self.assertFalse(get.called)
+
     @patch("requests.get")
     def test_restore_backoff(self, get):
         get.return_value = responses(304)
@@ -195,6 +266,27 @@ class UpdateTests(TestCase):
 
         self.assertEqual(count1, count2)
 
+    @patch('requests.get')
+    def test_unchanged_content(self, get):
+        get.return_value = responses(200, 'sw-all.xml')
+        feed = FeedFactory.create()
+        unique = UniqueFeed.objects.get()
+        self.assertEqual(len(unique.content_hash), 40)
+        count = feed.entries.count()
+        self.assertTrue(count > 0)
+
+        # Same body: no parsing, no storage
+        feed.entries.all().delete()
+        get.return_value = responses(200, 'sw-all.xml')
+        with patch('feedparser.parse') as parse:
+            update_feed(feed.url, content_hash=unique.content_hash)
+            self.assertFalse(parse.called)
+        self.assertEqual(feed.entries.count(), 0)
+
+        get.return_value = responses(200, 'sw-all.xml')
+        update_feed(feed.url, content_hash='outdated')
+        self.assertEqual(feed.entries.count(), count)
+
     @patch("requests.get")
     def test_uniquefeed_deletion(self, get):
         get.return_value = responses(304)
@@ -226,6 +318,59 @@ class UpdateTests(TestCase):
         update_feed(feed.url)
         self.assertEqual(UniqueFeed.objects.get().backoff_factor, 2)
 
+    @patch('requests.get')
+    def test_update_feeds_batch(self, get):
+        get.return_value = responses(304)
+        feeds = [FeedFactory.create() for i in range(4)]
+        gone = feeds[0].url
+
+        def fetch(url, **kwargs):
+            # Fresh responses: fetches run in several threads
+            if url == gone:
+                return responses(410)
+            return responses(502)
+        get.return_value = None
+        get.side_effect = fetch
+
+        update_feeds([feed.url for feed in feeds])
+        self.assertEqual(get.call_count, 8)
+        self.assertTrue(UniqueFeed.objects.get(url=gone).muted)
+        for unique in UniqueFeed.objects.exclude(url=gone):
+            self.assertFalse(unique.muted)
+            self.assertEqual(unique.error, '502')
+            self.assertEqual(unique.backoff_factor, 2)
+
+    @patch('requests.get')
+    def test_update_feeds_batch_errors(self, get):
+        get.return_value = responses(304)
+        feeds = [FeedFactory.create() for i in range(3)]
+        broken = feeds[0].url
+        handle_fetch = UniqueFeedManager.handle_fetch
+
+        def failing(manager, url, fetched, **kwargs):
+            if url == broken:
+                raise ValueError
+            return handle_fetch(manager, url, fetched, **kwargs)
+
+        get.side_effect = lambda url, **kwargs: responses(502)
+        with patch.object(UniqueFeedManager, 'handle_fetch', failing):
+            update_feeds([feed.url for feed in feeds])
+        self.assertEqual(get.call_count, 6)
+        # The broken feed is backed off, its neighbours are updated
+        for unique in UniqueFeed.objects.all():
+            self.assertEqual(unique.backoff_factor, 2)
+            self.assertEqual(unique.error,
+                             None if unique.url == broken else '502')
+
+    @patch('requests.get')
+    def test_update_feeds_batch_timeout(self, get):
+        get.return_value = responses(304)
+        feeds = [FeedFactory.create() for i in range(2)]
+        get.side_effect = JobTimeoutException
+        update_feeds([{'url': feed.url} for feed in feeds])
+        for unique in UniqueFeed.objects.all():
+            self.assertEqual(unique.backoff_factor, 2)
+
 
 class FaviconTests(TestCase):
     @patch("requests.get")
@@ -258,3 +403,63 @@ class FaviconTests(TestCase):
     def test_favicon_parse_error(self, get):
         get.side_effect = LocationParseError("Failed to parse url")
         Favicon.objects.update_favicon('http://example.com')
+
+
+class SessionPoolTests(TestCase):
+    def test_pooling(self):
+        pool = SessionPool(max_size=2)
+        session = pool.session('http://example.com/feed')
+        self.assertEqual(pool.misses, 1)
+        self.assertTrue(pool.session('http://EXAMPLE.com/other') is session)
+        self.assertEqual(pool.hits, 1)
+
+        # Different scheme, different connections
+        self.assertFalse(pool.session('https://example.com/feed') is session)
+        self.assertEqual(pool.misses, 2)
+
+        # Least recently used host goes away
+        pool.session('http://example.org/feed')
+        self.assertEqual(pool.stats(), {'size': 2, 'hits': 1, 'misses': 3,
+                                        'evictions': 1})
+        self.assertFalse(pool.session('http://example.com/feed') is session)
+
+    @patch('requests.Session.get')
+    def test_get(self, get):
+        pool = SessionPool(max_size=1)
+        with self.settings(TESTS=False):
+            pool.get('http://example.com/feed', timeout=10)
+            pool.get('http://example.com/other')
+            pool.get('http://example.org/feed')
+        self.assertEqual(get.call_count, 3)
+        get.assert_called_with('http://example.org/feed')
+        self.assertEqual(pool.stats(), {'size': 1, 'hits': 1, 'misses': 2,
+                                        'evictions': 1})
+
+    def test_no_cookies(self):
+        class Response(object):
+            def info(self):
+                return mimetools.Message(StringIO(
+                    'Set-Cookie: session=secret; Path=/\r\n\r\n'))
+
+        session = SessionPool().session('http://example.com/feed')
+        session.cookies.extract_cookies(
+            Response(), urllib2.Request('http://example.com/feed'))
+        self.assertEqual(len(session.cookies), 0)
+
+    @patch('time.time')
+    def test_idle_eviction(self, time):
+        pool = SessionPool(max_idle=60)
+        time.return_value = 1000
+        session = pool.session('http://example.com/feed')
+        pool.session('http://example.org/feed')
+        time.return_value = 1030
+        pool.session('http://example.org/feed')
+        self.assertTrue(pool.session('http://example.com/feed') is session)
+
+        time.return_value = 1100
+        pool.session('http://example.net/feed')
+        self.assertEqual(pool.evictions, 2)
+        self.assertEqual(len(pool.sessions), 1)
+
+        pool.clear()
+        self.assertEqual(pool.stats()['size'], 0)
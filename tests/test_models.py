@@ -1,11 +1,24 @@
+import time
+
+from datetime import timedelta
+
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 from mock import patch
+from rq import Queue
 
-from feedhq.feeds.models import Category, Feed, UniqueFeed, Entry
-from feedhq.feeds.tasks import update_feed
+from feedhq.feeds.models import (Category, Feed, UniqueFeed, Entry,
+                                 EntryContent, EntryManager)
+from feedhq.feeds.tasks import (decode_payload, encode_payloads,
+                                queue_entries, store_entries, store_pending,
+                                update_feed, STORE_FAILED_KEY, STORE_MARKER,
+                                STORE_PROCESSING_KEY, STORE_QUEUE_KEY,
+                                STORE_RECOVERY_DELAY)
+from feedhq.tasks import redis_connection, release
 
-from .factories import CategoryFactory, FeedFactory
+from .factories import CategoryFactory, EntryFactory, FeedFactory
 from . import responses
 
 
@@ -59,6 +72,309 @@ class ModelTests(TestCase):
         # __unicode__
         self.assertEqual('%s' % entry, title)
 
+    @patch('requests.get')
+    def test_shared_content(self, get):
+        get.return_value = responses(200, 'sw-all.xml')
+        feed = FeedFactory.create()
+        count = feed.entries.count()
+        contents = EntryContent.objects.count()
+        self.assertTrue(0 < contents <= count)
+
+        # Same entries for another subscriber: bodies aren't copied
+        get.return_value = responses(200, 'sw-all.xml')
+        other = FeedFactory.create(url=feed.url)
+        self.assertEqual(other.entries.count(), count)
+        self.assertEqual(EntryContent.objects.count(), contents)
+
+        entry = feed.entries.select_related('shared_content')[0]
+        twin = other.entries.get(link=entry.link)
+        self.assertEqual(entry.shared_content_id, twin.shared_content_id)
+        self.assertEqual(entry.inline_subtitle, '')
+        self.assertTrue(len(entry.subtitle) > 0)
+        self.assertEqual(twin.subtitle, entry.subtitle)
+
+        # Other entries keep their own body
+        entry = feed.entries.create(title='Inline', user=feed.user,
+                                    subtitle='Hello', date=timezone.now())
+        entry = Entry.objects.get(pk=entry.pk)
+        self.assertEqual(entry.shared_content, None)
+        self.assertEqual(entry.subtitle, 'Hello')
+
+    @patch('requests.get')
+    def test_store_entries(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        other = FeedFactory.create(url=feed.url)
+        now = timezone.now()
+        entries = [{
+            'title': 'Title {0}'.format(i),
+            'link': 'http://example.com/{0}'.format(i),
+            'guid': 'guid-{0}'.format(i),
+            'author': '',
+            'date': now,
+            'subtitle': '<div>Entry</div>',
+        } for i in range(3)]
+        # In-batch duplicate
+        entries.append(dict(entries[0], title='Duplicate'))
+
+        self.assertEqual(store_entries(feed.url, entries),
+                         set([feed.pk, other.pk]))
+        self.assertEqual(feed.entries.count(), 3)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 3)
+        self.assertEqual(EntryContent.objects.count(), 1)
+
+        # Known link or guid: skipped
+        entries = [
+            dict(entries[0], guid='new guid'),
+            dict(entries[1], link='http://example.com/new'),
+            dict(entries[2], link='http://example.com/3', guid='guid-3'),
+        ]
+        other.entries.all().delete()
+        self.assertEqual(store_entries(feed.url, entries),
+                         set([feed.pk, other.pk]))
+        self.assertEqual(feed.entries.count(), 4)
+        self.assertEqual(other.entries.count(), 3)
+        self.assertEqual(store_entries(feed.url, entries), set())
+
+    @patch('requests.get')
+    def test_sanitized_contents(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(url='http://example.com/feed/')
+        store_entries(feed.url, [{
+            'title': 'Title',
+            'link': 'http://example.com/1',
+            'guid': 'guid-1',
+            'date': timezone.now(),
+            'subtitle': ('<p onclick="foo()">Hello <a href="/link">link</a>'
+                         '<img src="img.png"></p>'),
+        }])
+        content = EntryContent.objects.get()
+        self.assertEqual(content.base_url, feed.url)
+        self.assertIn('href="http://example.com/link"', content.sanitized)
+        self.assertIn('src="http://example.com/feed/img.png"',
+                      content.sanitized)
+        self.assertNotIn('onclick', content.sanitized)
+        self.assertIn('href="http://example.com/link"',
+                      content.sanitized_nomedia)
+        self.assertNotIn('<img', content.sanitized_nomedia)
+
+        entry = Entry.objects.select_related('feed', 'shared_content').get()
+        with self.assertNumQueries(0):
+            self.assertEqual(entry.sanitized_content(), content.sanitized)
+
+        # Outdated sanitizer: sanitized on display, then by the backfill
+        EntryContent.objects.update(sanitizer_version=0, sanitized='')
+        entry = Entry.objects.select_related('feed', 'shared_content').get()
+        self.assertEqual(entry.sanitized_content(), content.sanitized)
+        call_command('sanitize_contents')
+        self.assertEqual(EntryContent.objects.get().sanitized,
+                         content.sanitized)
+
+    @patch('requests.get')
+    def test_entry_hashes(self, get):
+        get.return_value = responses(304)
+        entry = EntryFactory.create(guid=u'urn:\xe9t\xe9')
+        self.assertEqual(entry.link_hash, Entry.hash_for(entry.link))
+        self.assertEqual(Entry.hash_for('http://example.com/'),
+                         -6431396076138244110)
+
+        # The backfill computes the same hashes in SQL
+        Entry.objects.update(link_hash=None, guid_hash=None)
+        call_command('backfill_entry_hashes')
+        hashes = Entry.objects.values('link_hash', 'guid_hash').get()
+        self.assertEqual(hashes, {
+            'link_hash': Entry.hash_for(entry.link),
+            'guid_hash': Entry.hash_for(u'urn:\xe9t\xe9'),
+        })
+
+    @patch('requests.get')
+    def test_store_queue(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        other = FeedFactory.create()
+        same = FeedFactory.create(url=feed.url)
+        conn = redis_connection()
+        queue = Queue('store', connection=conn)
+        queue.empty()
+        conn.delete(STORE_QUEUE_KEY)
+        release(STORE_MARKER)
+        entry = {
+            'title': 'Title',
+            'link': 'http://example.com/1',
+            'guid': 'guid-1',
+            'date': timezone.now(),
+            'subtitle': 'Content',
+        }
+
+        with override_settings(RQ_EAGER=False, STORE_BATCH_SIZE=2):
+            queue_entries(feed.url, [entry])
+            queue_entries(other.url, [entry])
+            queue_entries(feed.url, [entry, dict(
+                entry, link='http://example.com/2', guid='guid-2')])
+            # A single drain job for all payloads
+            self.assertEqual(queue.count, 1)
+            self.assertEqual(Entry.objects.count(), 0)
+            queue.empty()
+
+            store_pending()
+            self.assertEqual(feed.entries.count(), 1)
+            self.assertEqual(same.entries.count(), 1)
+            self.assertEqual(other.entries.count(), 1)
+            self.assertEqual(conn.llen(STORE_QUEUE_KEY), 1)
+            self.assertEqual(queue.count, 1)
+
+            store_pending()
+            self.assertEqual(feed.entries.count(), 2)
+            self.assertEqual(Feed.objects.get(pk=same.pk).unread_count, 2)
+            self.assertEqual(conn.llen(STORE_QUEUE_KEY), 0)
+        queue.empty()
+        release(STORE_MARKER)
+
+    @patch('requests.get')
+    def test_store_queue_failures(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        conn = redis_connection()
+        queue = Queue('store', connection=conn)
+        queue.empty()
+        conn.delete(STORE_QUEUE_KEY, STORE_PROCESSING_KEY)
+        release(STORE_MARKER)
+        entry = {
+            'title': 'Title',
+            'link': 'http://example.com/1',
+            'guid': 'guid-1',
+            'date': timezone.now(),
+            'subtitle': 'Content',
+        }
+
+        with override_settings(RQ_EAGER=False):
+            queue_entries(feed.url, [entry])
+            queue.empty()
+
+            # Payloads go back to the queue when the drain job fails
+            with patch('feedhq.feeds.tasks.store_payloads') as store:
+                store.side_effect = ValueError
+                with self.assertRaises(ValueError):
+                    store_pending()
+            self.assertEqual(conn.llen(STORE_QUEUE_KEY), 1)
+            self.assertEqual(conn.zcard(STORE_PROCESSING_KEY), 0)
+            self.assertEqual(feed.entries.count(), 0)
+
+            # A drain job died while holding the payloads
+            processing = 'store:processing:dead'
+            conn.rpoplpush(STORE_QUEUE_KEY, processing)
+            conn.zadd(STORE_PROCESSING_KEY, processing,
+                      time.time() - STORE_RECOVERY_DELAY - 1)
+            store_pending()
+            self.assertEqual(feed.entries.count(), 1)
+            self.assertEqual(conn.llen(STORE_QUEUE_KEY), 0)
+            self.assertFalse(conn.exists(processing))
+            self.assertEqual(conn.zcard(STORE_PROCESSING_KEY), 0)
+
+            # Feeds that fail separately end up in the failed list
+            bad = FeedFactory.create()
+            store_many = EntryManager.store_many
+
+            def failing(manager, batches):
+                if any([feeds[0]['url'] == bad.url
+                        for feeds, items in batches if feeds]):
+                    raise ValueError
+                return store_many(manager, batches)
+
+            conn.delete(STORE_FAILED_KEY)
+            queue_entries(feed.url, [dict(entry, guid='guid-2',
+                                          link='http://example.com/2')])
+            queue_entries(bad.url, [entry])
+            with patch.object(EntryManager, 'store_many', failing):
+                store_pending()
+            self.assertEqual(feed.entries.count(), 2)
+            self.assertEqual(bad.entries.count(), 0)
+            self.assertEqual(queue.count, 0)
+            [payload] = conn.lrange(STORE_FAILED_KEY, 0, -1)
+            self.assertEqual(decode_payload(payload)['url'], bad.url)
+            conn.delete(STORE_FAILED_KEY)
+        queue.empty()
+        release(STORE_MARKER)
+
+    def test_store_payloads(self):
+        entries = [{
+            'title': 'Title {0}'.format(i),
+            'link': 'http://example.com/{0}'.format(i),
+            'guid': 'guid-{0}'.format(i),
+            'date': timezone.now(),
+            'subtitle': '<p>Content</p>' * 100,
+        } for i in range(10)]
+        [payload] = encode_payloads('http://example.com/feed', entries)
+        self.assertTrue(len(payload) < len(entries[0]['subtitle']))
+        decoded = decode_payload(payload)
+        self.assertEqual(decoded['url'], 'http://example.com/feed')
+        self.assertEqual([e['link'] for e in decoded['entries']],
+                         [e['link'] for e in entries])
+
+        with patch('feedhq.feeds.tasks.PAYLOAD_SIZE', 4000):
+            payloads = encode_payloads('http://example.com/feed', entries)
+        self.assertEqual(len(payloads), 5)
+        self.assertEqual(sum([len(decode_payload(p)['entries'])
+                              for p in payloads]), 10)
+        self.assertEqual(encode_payloads('http://example.com/feed', []), [])
+
+    @patch('requests.get')
+    def test_unread_counts(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        other = FeedFactory.create(user=feed.user)
+        EntryFactory.create_batch(3, feed=feed, user=feed.user)
+        EntryFactory.create(feed=other, user=feed.user)
+        EntryFactory.create(feed=other, user=feed.user, read=True)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 3)
+        self.assertEqual(Feed.objects.get(pk=other.pk).unread_count, 1)
+
+        entries = feed.user.entries.all()
+        self.assertEqual(Entry.objects.set_read(entries), 4)
+        self.assertEqual(Entry.objects.set_read(entries), 0)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 0)
+        self.assertEqual(Feed.objects.get(pk=other.pk).unread_count, 0)
+
+        self.assertEqual(Entry.objects.set_read(feed.entries.all(), False), 3)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 3)
+        self.assertEqual(Feed.objects.get(pk=other.pk).unread_count, 0)
+
+        Feed.objects.update(unread_count=42)
+        call_command('reconcile_unread_counts')
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 3)
+        self.assertEqual(Feed.objects.get(pk=other.pk).unread_count, 0)
+
+    @patch('requests.get')
+    def test_prune_entries(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        user = feed.user
+        old = timezone.now() - timedelta(days=100)
+        EntryFactory.create(feed=feed, user=user, date=old, read=True)
+        EntryFactory.create(feed=feed, user=user, date=old)
+        EntryFactory.create(feed=feed, user=user, date=old, read=True,
+                            starred=True)
+        EntryFactory.create(feed=feed, user=user, read=True,
+                            date=timezone.now() - timedelta(days=40))
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 1)
+
+        # Retention disabled by default
+        call_command('prune_entries', sleep=0)
+        self.assertEqual(user.entries.count(), 4)
+
+        call_command('prune_entries', days=365, sleep=0)
+        self.assertEqual(user.entries.count(), 4)
+        call_command('prune_entries', days=90, sleep=0, chunk=1)
+        self.assertEqual(user.entries.count(), 3)
+
+        user.retention_days = 30
+        user.save()
+        call_command('prune_entries', days=90, sleep=0)
+        self.assertEqual(user.entries.count(), 2)
+        self.assertEqual(user.entries.filter(read=False).count(), 1)
+        self.assertEqual(user.entries.filter(starred=True).count(), 1)
+        self.assertEqual(Feed.objects.get(pk=feed.pk).unread_count, 1)
+
     @patch("requests.get")
     def test_entry_model_behaviour(self, get):
         """Behaviour of the `Entry` model"""
@@ -4,11 +4,21 @@ from urllib import urlencode
 
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.http import HttpResponse
 from django.test import TestCase, Client
+from django.test.client import RequestFactory
+from django.utils import timezone
 from mock import patch
 
+from feedhq.feeds.changes import (CHANGE_FLOOR_KEY, CHANGE_LOG_KEY,
+                                  EPOCH_KEY, VERSION_KEY)
 from feedhq.feeds.models import Feed, Entry, UniqueFeed
-from feedhq.reader.views import GoogleReaderXMLRenderer, item_id
+from feedhq.feeds.tasks import store_entries
+from feedhq.reader.management.commands.benchmark_serializers import (
+    LegacyXMLRenderer, legacy_serialize)
+from feedhq.reader.views import (GoogleReaderXMLRenderer, ITEM_FIELDS,
+                                 ItemSerializer, get_unique_map, item_id)
+from feedhq.tasks import redis_connection
 
 from .factories import UserFactory, CategoryFactory, FeedFactory, EntryFactory
 from . import responses
@@ -26,7 +36,15 @@ def clientlogin(token):
 class ApiClient(Client):
     def request(self, **request):
         response = super(ApiClient, self).request(**request)
-        if response['Content-Type'] == 'application/json':
+        if response.streaming:
+            # Consumed right away so that queries are counted
+            streamed = HttpResponse(''.join(response.streaming_content),
+                                    status=response.status_code)
+            for header, value in response.items():
+                streamed[header] = value
+            streamed.streamed = True
+            response = streamed
+        if response.get('Content-Type') == 'application/json':
             response.json = json.loads(response.content)
         return response
 
@@ -148,6 +166,14 @@ class SerializerTest(ApiTest):
         serializer.render({'stuff': ({'foo': 'bar'}, {'baz': 'blah'})})
         serializer.render({})
         serializer.render({'list': ('of', 'strings')})
+
+        data = {'items': [{
+            'title': u'caf\xe9 <b>&amp;</b>',
+            'id': '12',
+            'categories': ['user/1/label/"quoted"'],
+        }]}
+        self.assertEqual(serializer.render(data),
+                         LegacyXMLRenderer().render(data))
         with self.assertRaises(AssertionError):
             serializer.render(12.5)
 
@@ -401,21 +427,37 @@ class ReaderApiTest(ApiTest):
         feed.update_unread_count()
         feed2.update_unread_count()
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, **clientlogin(token))
 
         # 3 elements: reading-list, label and feed
         self.assertEqual(len(response.json['unreadcounts']), 4)
 
+        newest = feed.entries.order_by('-date')[0].date.strftime("%s000000")
         for count in response.json['unreadcounts']:
             if count['id'].endswith(feed2.url):
                 self.assertEqual(count['count'], 1)
             elif count['id'].endswith(feed.category.name):
                 self.assertEqual(count['count'], 5)
+                self.assertEqual(count['newestItemTimestampUsec'], newest)
             elif count['id'].endswith('reading-list'):
                 self.assertEqual(count['count'], 6)
             else:
                 self.assertEqual(count['count'], 5)
+                self.assertEqual(count['newestItemTimestampUsec'], newest)
+
+        # Cached until something changes
+        with self.assertNumQueries(0):
+            cached = self.client.get(url, **clientlogin(token))
+        self.assertEqual(cached.json, response.json)
+
+        Entry.objects.set_read(feed2.entries.all())
+        with self.assertNumQueries(1):
+            response = self.client.get(url, **clientlogin(token))
+        # feed2 is gone, reading-list is down to 5
+        self.assertEqual(len(response.json['unreadcounts']), 3)
+        for count in response.json['unreadcounts']:
+            self.assertEqual(count['count'], 5)
 
     def test_stream_content(self, get):
         get.return_value = responses(304)
@@ -425,7 +467,7 @@ class ReaderApiTest(ApiTest):
                       args=['user/-/state/com.google/reading-list'])
 
         # 2 are warmup queries, cached in following calls
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             response = self.client.get(url, **clientlogin(token))
         self.assertEqual(response.json['author'], user.username)
         self.assertEqual(len(response.json['items']), 0)
@@ -463,20 +505,34 @@ class ReaderApiTest(ApiTest):
         EntryFactory.create(user=user, feed=feed, read=True, broadcast=True)
 
         # Warm up the uniques map cache
-        with self.assertNumQueries(3):
+        with self.assertNumQueries(2):
             response = self.client.get(url, **clientlogin(token))
-        self.assertEqual(response.json['continuation'], 'page2')
+        continuation = response.json['continuation']
         self.assertEqual(len(response.json['items']), 20)
+        ids = [item['id'] for item in response.json['items']]
+
+        # The continuation resumes after the last item
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'c': continuation},
+                                       **clientlogin(token))
+        self.assertEqual(len(response.json['items']), 10)
+        self.assertFalse('continuation' in response.json)
+        self.assertFalse(set(ids) & set([
+            item['id'] for item in response.json['items']]))
+
+        response = self.client.get(url, {'c': continuation, 'r': 'o'},
+                                   **clientlogin(token))
+        self.assertEqual(len(response.json['items']), 19)
 
         # ?xt= excludes stuff
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(
                 url, {'xt': 'user/-/state/com.google/starred', 'n': 40},
                 **clientlogin(token))
         self.assertEqual(len(response.json['items']), 20)
 
         # Multiple ?xt= is valid.
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(
                 url, {'xt': [
                     'user/-/state/com.google/starred',
@@ -486,36 +542,36 @@ class ReaderApiTest(ApiTest):
                 **clientlogin(token))
         self.assertEqual(len(response.json['items']), 19)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(
                 url, {'xt': 'user/-/state/com.google/broadcast', 'n': 40},
                 **clientlogin(token))
         self.assertEqual(len(response.json['items']), 29)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(
                 url, {'xt': 'user/-/state/com.google/kept-unread', 'n': 40},
                 **clientlogin(token))
         self.assertEqual(len(response.json['items']), 5)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(
                 url, {'xt': 'user/-/state/com.google/read', 'n': 40},
                 **clientlogin(token))
         self.assertEqual(len(response.json['items']), 25)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(
                 url, {'xt': 'feed/{0}'.format(feed.url)}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 0)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(
                 url, {'xt': 'user/-/label/{0}'.format(feed.category.name)},
                 **clientlogin(token))
         self.assertEqual(len(response.json['items']), 0)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {'c': 'page2'},
                                        **clientlogin(token))
         self.assertEqual(len(response.json['items']), 10)
@@ -523,43 +579,67 @@ class ReaderApiTest(ApiTest):
         self.assertTrue(response.json['self'][0]['href'].endswith(
             'reading-list?c=page2'))
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 30)
         self.assertFalse('continuation' in response.json)
+        self.assertTrue(response.streamed)
+
+        # Items are written in chunks, the continuation after them
+        with patch('feedhq.reader.renderers.STREAM_CHUNK_ITEMS', 7):
+            response = self.client.get(url, {'n': 25}, **clientlogin(token))
+            self.assertEqual(len(response.json['items']), 25)
+            self.assertEqual(len(set([
+                item['id'] for item in response.json['items']])), 25)
+            self.assertTrue('continuation' in response.json)
+
+            response = self.client.get(url, {'n': 25, 'output': 'xml'},
+                                       **clientlogin(token))
+            self.assertEqual(response['Content-Type'], 'application/xml')
+            content = response.content
+            self.assertEqual(content.count('name="crawlTimeMsec"'), 25)
+            self.assertTrue(content.index('<list name="items">') <
+                            content.index('name="continuation"'))
+
+            response = self.client.get(url, {'n': 25, 'output': 'atom'},
+                                       **clientlogin(token))
+            self.assertEqual(response['Content-Type'], 'text/xml')
+            self.assertTrue(response.content.startswith('<?xml'))
+            self.assertTrue(response.content.endswith('</feed>'))
+            self.assertEqual(response.content.count('<entry '), 25)
 
         url = reverse('reader:stream_contents',
                       args=['user/-/state/com.google/starred'])
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 10)
 
         url = reverse('reader:stream_contents',
                       args=['user/-/label/{0}'.format(feed.category.name)])
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 30)
 
         url = reverse('reader:stream_contents',
                       args=['feed/{0}'.format(feed.url)])
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 30)
 
         url = reverse('reader:stream_contents',
                       args=['user/-/state/com.google/broadcast'])
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 1)
 
         url = reverse('reader:stream_contents',
                       args=['user/-/state/com.google/kept-unread'])
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 25)
 
         url = reverse('reader:stream_contents')  # defaults to reading-list
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 20)
 
@@ -575,10 +655,163 @@ class ReaderApiTest(ApiTest):
 
         url = reverse('reader:stream_contents',
                       args=['user/-/state/com.google/like'])
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
         self.assertEqual(len(response.json['items']), 0)
 
+    def test_etag(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        feed = FeedFactory.create(category__user=user, user=user)
+        entry = EntryFactory.create(feed=feed, user=user)
+        url = reverse('reader:unread_count')
+
+        response = self.client.get(url, **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag,
+                                       **clientlogin(token))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        # Changes get a new version
+        for changed in (
+            lambda: Entry.objects.set_read(user.entries.all()),
+            lambda: EntryFactory.create(feed=feed, user=user),
+            lambda: self.client.post(reverse('reader:edit_tag'), {
+                'T': self.post_token(token),
+                'i': entry.pk,
+                'a': 'user/-/state/com.google/starred',
+            }, **clientlogin(token)),
+        ):
+            changed()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag,
+                                       **clientlogin(token))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
+        # Versions restarting after redis lost them don't match
+        redis_connection().delete(VERSION_KEY.format(user.pk),
+                                  EPOCH_KEY.format(user.pk))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag,
+                                   **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        # Versions are per user
+        other = UserFactory.create()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag,
+                                   **clientlogin(self.auth_token(other)))
+        self.assertEqual(response.status_code, 200)
+
+    def test_changes(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        feed = FeedFactory.create(category__user=user, user=user)
+        entry = EntryFactory.create(feed=feed, user=user)
+        url = reverse('reader:changes')
+
+        response = self.client.get(url, {'output': 'json'},
+                                   **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['reset'])
+        cursor = response.json['cursor']
+
+        response = self.client.get(url, {'since': 'foo', 'output': 'json'},
+                                   **clientlogin(token))
+        self.assertEqual(response.status_code, 400)
+
+        new = EntryFactory.create(feed=feed, user=user)
+        Entry.objects.set_read(user.entries.filter(pk=entry.pk))
+        response = self.client.post(reverse('reader:edit_tag'), {
+            'T': self.post_token(token),
+            'i': entry.pk,
+            'a': 'user/-/state/com.google/starred',
+        }, **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+        other = FeedFactory.create(category__user=user, user=user)
+        feed.delete()
+
+        response = self.client.get(url, {'since': cursor, 'output': 'json'},
+                                   **clientlogin(token))
+        self.assertEqual(response.status_code, 200)
+        data = response.json
+        self.assertFalse('reset' in data)
+        self.assertEqual(data['newItemIds'], [str(new.pk)])
+        self.assertEqual(data['readItemIds'], [str(entry.pk)])
+        self.assertEqual(data['unreadItemIds'], [])
+        self.assertEqual(data['starredItemIds'], [str(entry.pk)])
+        self.assertEqual(data['subscribed'], [u'feed/{0}'.format(other.url)])
+        self.assertEqual(data['unsubscribed'], [u'feed/{0}'.format(feed.url)])
+        self.assertEqual(data['edited'], [])
+
+        # Nothing changed since the new cursor
+        response = self.client.get(url, {'since': data['cursor'],
+                                         'output': 'json'},
+                                   **clientlogin(token))
+        self.assertEqual(response.json['newItemIds'], [])
+        self.assertEqual(response.json['subscribed'], [])
+
+        # Unknown cursors require a reset
+        response = self.client.get(url, {'since': int(data['cursor']) + 10,
+                                         'output': 'json'},
+                                   **clientlogin(token))
+        self.assertTrue(response.json['reset'])
+
+        # Only the states that changed are logged
+        entry = EntryFactory.create(feed=other, user=user)
+        cursor = self.client.get(url, {'output': 'json'},
+                                 **clientlogin(token)).json['cursor']
+        entry = Entry.objects.get(pk=entry.pk)
+        entry.broadcast = True
+        entry.save()
+        response = self.client.get(url, {'since': cursor, 'output': 'json'},
+                                   **clientlogin(token))
+        self.assertEqual(response.json['broadcastItemIds'], [str(entry.pk)])
+        self.assertEqual(response.json['unreadItemIds'], [])
+        self.assertEqual(response.json['unstarredItemIds'], [])
+
+        # The log expires
+        redis = redis_connection()
+        self.assertTrue(redis.ttl(CHANGE_LOG_KEY.format(user.pk)) > 0)
+        self.assertTrue(redis.ttl(CHANGE_FLOOR_KEY.format(user.pk)) > 0)
+        redis.delete(CHANGE_LOG_KEY.format(user.pk),
+                     CHANGE_FLOOR_KEY.format(user.pk))
+        response = self.client.get(url, {'since': cursor, 'output': 'json'},
+                                   **clientlogin(token))
+        self.assertTrue(response.json['reset'])
+
+    def test_item_serializer(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        feed = FeedFactory.create(category__user=user, user=user)
+        store_entries(feed.url, [{
+            'title': u'Title {0}'.format(i),
+            'link': u'http://example.com/{0}'.format(i),
+            'guid': u'guid-{0}'.format(i),
+            'author': u'',
+            'date': timezone.now(),
+            'subtitle': u'<p>Entry {0}</p>'.format(i),
+        } for i in range(3)])
+        other = FeedFactory.create(category=None, user=user)
+        EntryFactory.create(feed=other, user=user, read=True, starred=True,
+                            broadcast=True)
+
+        request = RequestFactory().get('/')
+        request.user = user
+        uniques = get_unique_map(user)
+        serialize = ItemSerializer(request, uniques)
+        items = [serialize(row) for row in user.entries.values(*ITEM_FIELDS)]
+        self.assertEqual(len(items), 4)
+        self.assertEqual(items, [
+            legacy_serialize(request, entry, uniques)
+            for entry in user.entries.all()])
+
     def test_stream_items_ids(self, get):
         get.return_value = responses(304)
         url = reverse("reader:stream_items_ids")
@@ -600,32 +833,46 @@ class ReaderApiTest(ApiTest):
                                    **clientlogin(token))
         self.assertEqual(response.status_code, 400)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.post('{0}?{1}'.format(url, urlencode({
                 'n': 5, 's': 'user/-/state/com.google/reading-list',
                 'includeAllDirectStreamIds': 'true'})),
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue('continuation' in response.json)
+        last = int(response.json['itemRefs'][-1]['id'])
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {
+                'n': 5, 's': 'user/-/state/com.google/reading-list',
+                'c': response.json['continuation']}, **clientlogin(token))
+        self.assertEqual(len(response.json['itemRefs']), 5)
+        self.assertFalse(last in [int(ref['id']) for ref in
+                                  response.json['itemRefs']])
+
+        response = self.client.get(url, {
+            'n': 5, 's': 'user/-/state/com.google/reading-list',
+            'c': 'foo'}, **clientlogin(token))
+        self.assertEqual(response.status_code, 400)
+
+        with self.assertNumQueries(1):
             response = self.client.post('{0}?{1}'.format(url, urlencode({
                 'n': 5, 's': 'user/{0}/state/com.google/reading-list'.format(
                     user.pk),
                 'includeAllDirectStreamIds': 'true'})),
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue('continuation' in response.json)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {
                 'n': 5, 's': 'splice/user/-/state/com.google/reading-list',
                 'includeAllDirectStreamIds': 'true'},
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue('continuation' in response.json)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {
                 'n': 5,
                 's': 'splice/user/{0}/state/com.google/reading-list'.format(
@@ -633,9 +880,9 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'},
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertTrue('continuation' in response.json)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {
                 'n': 5, 's': 'splice/user/-/state/com.google/reading-list',
                 'c': 'page2', 'includeAllDirectStreamIds': 'true'},
@@ -643,7 +890,7 @@ class ReaderApiTest(ApiTest):
         self.assertEqual(len(response.json['itemRefs']), 5)
         self.assertFalse('continuation' in response.json)
 
-        with self.assertNumQueries(2):
+        with self.assertNumQueries(1):
             response = self.client.get(url, {
                 'n': 50, 's': (
                     'splice/user/-/state/com.google/broadcast|'
@@ -1,15 +1,29 @@
 from datetime import timedelta
 from mock import patch
+from rq import Queue
 
 import feedparser
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 
-from feedhq.feeds.management.commands.updatefeeds import TO_UPDATE
-from feedhq.feeds.models import UniqueFeed
+from feedhq.feeds.management.commands.updatefeeds import (
+    TO_UPDATE, UNMUTED_COUNT_KEY)
+from feedhq.feeds.models import UniqueFeed, UniqueFeedManager
+from feedhq.feeds.management.commands.scheduler import Command as Scheduler
+from feedhq.feeds.scheduling import (interleave, parse_retry_after,
+                                     throttle_host, schedule_feed,
+                                     pop_due_feeds, scheduled_feeds,
+                                     next_due_in, enqueue_updates,
+                                     backpressure, batch_timeout,
+                                     schedule_lag, SCHEDULE_KEY)
+from feedhq.feeds.tasks import update_marker
+from feedhq.tasks import (claim, claim_many, duplicates, enqueue_many,
+                          redis_connection, release, DUPLICATES_KEY)
 from feedhq.feeds.utils import USER_AGENT
 
 from .factories import FeedFactory
@@ -17,6 +31,10 @@ from . import responses
 
 
 class UpdateTests(TestCase):
+    def setUp(self):  # noqa
+        cache.delete(UNMUTED_COUNT_KEY)
+        redis_connection().delete(SCHEDULE_KEY, DUPLICATES_KEY)
+
     def test_update_feeds(self):
         to_update = TO_UPDATE % 5
         u = UniqueFeed.objects.create(
@@ -50,7 +68,9 @@ class UpdateTests(TestCase):
             self.assertEqual(feeds[0].url, u.url)
             self.assertEqual(feeds[0].tm, 180)
 
-        UniqueFeed.objects.update(last_update=timezone.now())
+        UniqueFeed.objects.update(last_update=timezone.now(),
+                                  next_update=timezone.now() + timedelta(
+                                      hours=1))
         with self.assertNumQueries(1):
             self.assertEqual(len(list(UniqueFeed.objects.raw(to_update))), 0)
 
@@ -129,6 +149,7 @@ class UpdateTests(TestCase):
         UniqueFeed.objects.all().update(
             last_loop=timezone.now() - timedelta(hours=10),
             last_update=timezone.now() - timedelta(hours=10),
+            next_update=timezone.now() - timedelta(hours=9),
         )
 
         unique = UniqueFeed.objects.all()[0]
@@ -140,5 +161,336 @@ class UpdateTests(TestCase):
             # count(), select, set last loop, set last update (x2)
             call_command('updatefeeds')
 
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(4):
+            # count() is cached
+            call_command('updatefeeds')
+
+    @patch("requests.get")
+    def test_updatefeeds_batching(self, get):
+        get.return_value = responses(304)
+
+        for i in range(24):
+            FeedFactory.create()
+        UniqueFeed.objects.all().update(
+            last_loop=timezone.now() - timedelta(hours=10),
+            last_update=timezone.now() - timedelta(hours=10),
+            next_update=timezone.now() - timedelta(hours=9),
+        )
+
+        with override_settings(FETCH_BATCH_SIZE=3):
+            call_command('updatefeeds')
+
+        # 24 // 12 feeds due, fetched in a single batch
+        self.assertEqual(UniqueFeed.objects.filter(
+            last_update__gte=timezone.now() - timedelta(minutes=1)).count(),
+            2)
+
+    def test_update_interval(self):
+        now = timezone.now()
+
+        def parsed(*ages):
+            return feedparser.FeedParserDict(entries=[
+                {'published_parsed': (now - age).utctimetuple()}
+                for age in ages
+            ])
+
+        interval = UniqueFeedManager.update_interval
+        # Hourly posts: polled every 30 minutes
+        self.assertEqual(interval(parsed(timedelta(minutes=10),
+                                         timedelta(minutes=70),
+                                         timedelta(minutes=130))), 30)
+        # Smoothed with the previous value
+        self.assertEqual(interval(parsed(timedelta(minutes=10),
+                                         timedelta(minutes=70),
+                                         timedelta(minutes=130)), 60), 45)
+        # Busy feeds are capped
+        self.assertEqual(interval(parsed(timedelta(minutes=1),
+                                         timedelta(minutes=2))), 15)
+        # Monthly posts, or a feed that went quiet
+        self.assertEqual(interval(parsed(timedelta(days=30),
+                                         timedelta(days=60))), 60 * 24)
+        # Not enough dates to tell
+        self.assertEqual(interval(parsed(timedelta(days=1)), 60), 60)
+        self.assertEqual(interval(feedparser.FeedParserDict(entries=[
+            {}, {}])), None)
+
+        u = UniqueFeed.objects.create(
+            url='http://example.com/quiet',
+            last_update=timezone.now() - timedelta(hours=2),
+        )
+        self.assertEqual(len(list(UniqueFeed.objects.raw(TO_UPDATE % 5))), 1)
+        u.update_interval = 60 * 24
+        u.save()
+        self.assertEqual(len(list(UniqueFeed.objects.raw(TO_UPDATE % 5))), 0)
+
+    def test_interleave(self):
+        urls = [
+            'http://a.com/1', 'http://a.com/2', 'http://a.com/3',
+            'http://b.com/1', 'http://B.com/2', 'https://c.com/1',
+        ]
+        scheduled, deferred = interleave(urls, url=lambda url: url)
+        self.assertEqual(scheduled, [
+            'http://a.com/1', 'http://b.com/1', 'https://c.com/1',
+            'http://a.com/2', 'http://B.com/2', 'http://a.com/3',
+        ])
+        self.assertEqual(deferred, [])
+
+        scheduled, deferred = interleave(urls, max_per_host=1,
+                                         url=lambda url: url)
+        self.assertEqual(scheduled, [
+            'http://a.com/1', 'http://b.com/1', 'https://c.com/1'])
+        self.assertEqual(deferred, [
+            'http://a.com/2', 'http://a.com/3', 'http://B.com/2'])
+
+    def test_retry_after(self):
+        self.assertEqual(parse_retry_after(None), 600)
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('1'), 60)
+        self.assertEqual(parse_retry_after('86400'), 3600)
+        self.assertEqual(
+            parse_retry_after('Fri, 31 Dec 1999 23:59:59 GMT'), 60)
+        self.assertEqual(parse_retry_after('garbage'), 600)
+
+    @patch("requests.get")
+    def test_updatefeeds_throttled_hosts(self, get):
+        get.return_value = responses(304)
+        for i in range(22):
+            FeedFactory.create()
+        FeedFactory.create(url='http://throttled.com/feed')
+        FeedFactory.create(url='http://example.com/feed')
+        UniqueFeed.objects.all().update(
+            last_loop=timezone.now() - timedelta(hours=10),
+            last_update=timezone.now() - timedelta(hours=10),
+            next_update=timezone.now() - timedelta(hours=9),
+        )
+        # 24 // 12 feeds are due, make sure those two are picked
+        last_loop = timezone.now() - timedelta(hours=20)
+        UniqueFeed.objects.filter(url__in=[
+            'http://throttled.com/feed', 'http://example.com/feed',
+        ]).update(last_loop=last_loop)
+        throttle_host('throttled.com', 60)
+        try:
+            call_command('updatefeeds')
+        finally:
+            cache.clear()
+        self.assertEqual(
+            UniqueFeed.objects.get(url='http://throttled.com/feed').last_loop,
+            last_loop)
+        self.assertTrue(UniqueFeed.objects.get(
+            url='http://example.com/feed').last_loop > last_loop)
+
+    def test_schedule(self):
+        now = timezone.now()
+        self.assertEqual(next_due_in(), None)
+        schedule_feed('http://example.com/1', now - timedelta(minutes=2))
+        schedule_feed('http://example.com/2', now - timedelta(minutes=1))
+        schedule_feed('http://example.com/3', now + timedelta(minutes=1))
+        self.assertEqual(next_due_in(), 0)
+
+        self.assertEqual(pop_due_feeds(1), ['http://example.com/1'])
+        self.assertEqual(pop_due_feeds(10), ['http://example.com/2'])
+        self.assertEqual(pop_due_feeds(10), [])
+        self.assertTrue(50 < next_due_in() <= 60)
+        self.assertEqual(scheduled_feeds(), set(['http://example.com/3']))
+
+    @patch("requests.get")
+    def test_scheduler(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        # Scheduled by the first update
+        self.assertEqual(scheduled_feeds(), set([feed.url]))
+        self.assertEqual(get.call_count, 1)
+
+        scheduler = Scheduler()
+        self.assertEqual(scheduler.tick(10), 0)
+
+        schedule_feed(feed.url, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(scheduler.tick(10), 1)
+        self.assertEqual(get.call_count, 2)
+        self.assertTrue(next_due_in() > 50 * 60)
+
+        # Lost jobs are recovered, in-flight ones are left alone
+        redis_connection().delete(SCHEDULE_KEY)
+        scheduler.sync()
+        self.assertEqual(scheduled_feeds(), set())
+        UniqueFeed.objects.update(
+            last_loop=timezone.now() - timedelta(hours=2))
+        scheduler.sync()
+        self.assertEqual(scheduled_feeds(), set([feed.url]))
+
+        schedule_feed('http://example.com/gone', timezone.now())
+        scheduler.sync()
+        self.assertEqual(scheduled_feeds(), set([feed.url]))
+
+        UniqueFeed.objects.get().delete()
+        schedule_feed(feed.url, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(scheduler.tick(10), 1)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(scheduled_feeds(), set())
+
+    @patch("time.sleep")
+    def test_scheduler_errors(self, sleep):
+        scheduler = Scheduler()
+        sleep.side_effect = [None, KeyboardInterrupt]
+        with patch.object(scheduler, 'poll') as poll:
+            # The loop survives failing polls
+            poll.side_effect = [ValueError, 2]
+            with self.assertRaises(KeyboardInterrupt):
+                scheduler.handle_sentry(batch=100, sync=3600, max_sleep=5)
+        self.assertEqual(poll.call_count, 2)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [5, 2])
+
+    def test_claim(self):
+        key = update_marker(u'http://example.com/f\xe9ed')
+        release(key)
+        self.assertTrue(claim(key, 'update_feed'))
+        self.assertFalse(claim(key, 'update_feed'))
+        self.assertFalse(claim(key, 'update_feed'))
+        self.assertEqual(duplicates(), {'update_feed': 2})
+        self.assertTrue(redis_connection().ttl(key) > 0)
+        release(key)
+        self.assertTrue(claim(key, 'update_feed'))
+        release(key)
+
+    @patch("requests.get")
+    def test_new_subscriber_fetch(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        UniqueFeed.objects.update(etag='etag')
+        # A regular update is waiting in the queue
+        marker = update_marker(feed.url)
+        claim(marker, 'update_feed')
+
+        FeedFactory.create(url=feed.url)
+        self.assertEqual(get.call_count, 2)
+        self.assertNotIn('If-None-Match', get.call_args[1]['headers'])
+        # Still held by the queued update
+        self.assertFalse(claim(marker, 'update_feed'))
+        release(marker)
+
+    @patch("requests.get")
+    def test_updatefeeds_duplicates(self, get):
+        get.return_value = responses(304)
+
+        for i in range(24):
+            FeedFactory.create()
+        self.assertEqual(get.call_count, 24)
+        UniqueFeed.objects.all().update(
+            last_loop=timezone.now() - timedelta(hours=10),
+            last_update=timezone.now() - timedelta(hours=10),
+            next_update=timezone.now() - timedelta(hours=9),
+        )
+        # Jobs still waiting in the queue for all feeds
+        markers = [update_marker(u.url) for u in UniqueFeed.objects.all()]
+        for marker in markers:
+            claim(marker, 'update_feed')
+
+        call_command('updatefeeds')
+        self.assertEqual(get.call_count, 24)
+        self.assertEqual(duplicates(), {'update_feed': 2})
+        # Considered queued
+        self.assertEqual(UniqueFeed.objects.filter(
+            last_loop__gte=timezone.now() - timedelta(minutes=1)).count(), 2)
+
+        with override_settings(FETCH_BATCH_SIZE=3):
+            call_command('updatefeeds')
+        self.assertEqual(get.call_count, 24)
+        self.assertEqual(duplicates(), {'update_feed': 4})
+
+        release(*markers)
+        call_command('updatefeeds')
+        self.assertEqual(get.call_count, 26)
+
+    def test_enqueue_many(self):
+        queue = Queue('test_enqueue_many', connection=redis_connection())
+        queue.empty()
+        release('unique:1', 'unique:2')
+        self.assertEqual(claim_many(['unique:1', 'unique:1'], 'dummy'),
+                         [True, False])
+        with override_settings(RQ_EAGER=False):
+            count = enqueue_many([{
+                'function': update_marker,
+                'args': ['http://example.com/{0}'.format(i)],
+            } for i in range(10)] + [{
+                'function': update_marker,
+                'args': ['http://example.com/unique'],
+                'unique_key': 'unique:{0}'.format(i),
+            } for i in (1, 2, 2)], queue='test_enqueue_many')
+        self.assertEqual(count, 11)
+        self.assertEqual(queue.count, 11)
+        self.assertEqual(queue.jobs[0].args, ('http://example.com/0',))
+        self.assertEqual(duplicates(), {'dummy': 1, 'update_marker': 2})
+        queue.empty()
+        release('unique:1', 'unique:2')
+
+    def test_compact_jobs(self):
+        queue = Queue('default', connection=redis_connection())
+        queue.empty()
+        feed = UniqueFeed.objects.create(url='http://example.com/compact',
+                                         etag='etag')
+        release(update_marker(feed.url))
+        with override_settings(RQ_EAGER=False):
+            enqueue_updates([feed], set())
+        [job] = queue.jobs
+        self.assertEqual(job.args, (feed.url,))
+        self.assertEqual(job.kwargs, {})
+        queue.empty()
+        release(update_marker(feed.url))
+
+    def test_batch_timeout(self):
+        queue = Queue('default', connection=redis_connection())
+        queue.empty()
+        feeds = [UniqueFeed.objects.create(
+            url='http://example.com/{0}'.format(i)) for i in range(6)]
+        release(*[update_marker(feed.url) for feed in feeds])
+        with override_settings(RQ_EAGER=False, FETCH_BATCH_SIZE=10,
+                               FETCH_CONCURRENCY=20, FETCH_HOST_CONCURRENCY=2):
+            enqueue_updates(feeds, set())
+            # A single host is fetched 2 feeds at a time
+            [job] = queue.jobs
+            self.assertEqual(len(job.args[0]), 6)
+            self.assertEqual(job.timeout, 3 * UniqueFeed.TIMEOUT_BASE)
+
+            others = [UniqueFeed(url='http://{0}.example.org/'.format(i))
+                      for i in range(6)]
+            self.assertEqual(batch_timeout(others), UniqueFeed.TIMEOUT_BASE)
+        queue.empty()
+        release(*[update_marker(feed.url) for feed in feeds])
+
+    @patch("feedhq.feeds.scheduling.queue_length")
+    @patch("requests.get")
+    def test_backpressure(self, get, queue_length):
+        get.return_value = responses(304)
+        queue_length.return_value = 0
+        for i in range(24):
+            FeedFactory.create()
+        self.assertEqual(get.call_count, 24)
+        UniqueFeed.objects.all().update(
+            last_loop=timezone.now() - timedelta(hours=10),
+            last_update=timezone.now() - timedelta(hours=10),
+            next_update=timezone.now() - timedelta(hours=9),
+        )
+        redis_connection().delete(SCHEDULE_KEY)
+        for unique in UniqueFeed.objects.all():
+            schedule_feed(unique.url, unique.next_update)
+        due, lag = schedule_lag()
+        self.assertEqual(due, 24)
+        self.assertTrue(9 * 3600 - 60 < lag <= 9 * 3600)
+
+        with override_settings(FETCH_QUEUE_TARGET=100):
+            self.assertEqual(backpressure(10), 10)
+            queue_length.return_value = 98
+            self.assertEqual(backpressure(10), 2)
+            with override_settings(FETCH_BATCH_SIZE=3):
+                self.assertEqual(backpressure(10), 6)
+
+            # Backlog over target: nothing is enqueued
+            queue_length.return_value = 150
+            self.assertEqual(backpressure(10), 0)
+            call_command('updatefeeds')
+            self.assertEqual(get.call_count, 24)
+
+            queue_length.return_value = 0
             call_command('updatefeeds')
+            self.assertEqual(get.call_count, 26)